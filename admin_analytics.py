@@ -0,0 +1,62 @@
+import pandas as pd
+
+import db
+
+# --- 管理者画面の集計パイプライン ---
+# 社員ごとのループ（絞り込み・並べ替え・iterrows）をやめ、社員マスタとの結合、直近ログの整形、
+# HTMLテーブルの生成をそれぞれ DataFrame 全体に対する1回の処理で行う。
+
+SUMMARY_COLUMN = "活動内容要約"
+PENDING_TEXT = "生成中..."
+
+
+def employee_frame(employee_master):
+    frame = pd.DataFrame.from_dict(employee_master, orient="index")
+    frame = frame.reindex(columns=["name", "department"]).rename(columns={"department": "dept"})
+    frame.index.name = "employee_id"
+    return frame.reset_index()
+
+
+def build_summary_frame(overview, employee_master):
+    # 活動集計（employee_id, last_active, max_id）に氏名・部署とキャッシュ用fingerprintを付ける
+    summary = overview.merge(employee_frame(employee_master), on="employee_id", how="left")
+    summary[["name", "dept"]] = summary[["name", "dept"]].fillna("不明")
+    summary["fingerprint"] = summary["max_id"].astype(str) + ":" + summary["last_active"].astype(str)
+    return summary
+
+
+def build_log_texts(windows):
+    # get_recent_windows の結果（社員ごと新しい順）を {employee_id: プロンプト用テキスト} にまとめる
+    if windows.empty:
+        return {}
+    lines = windows["timestamp"].astype(str) + " [" + windows["role"].astype(str) + "]: " + windows["content"].fillna("").astype(str)
+    return lines.groupby(windows["employee_id"], sort=False).agg("\n".join).to_dict()
+
+
+def load_log_texts(employee_ids, limit=20):
+    return build_log_texts(db.get_recent_windows(list(employee_ids), limit))
+
+
+def summary_table_html(summary):
+    cells = ("<tr><td>" + summary["name"].astype(str) + "</td><td>" + summary["dept"].astype(str) + "</td><td>"
+             + summary["last_active"].astype(str)
+             + "</td><td style='max-width:600px; word-break:break-all; white-space:pre-line'>"
+             + summary[SUMMARY_COLUMN].astype(str) + "</td></tr>")
+    return ("<table class='activity-summary-table'>"
+            "<tr><th>name</th><th>dept</th><th>last_active</th><th>活動内容要約</th></tr>"
+            + "".join(cells) + "</table>")
+
+
+def department_weekly(weekly, employee_master, value="messages"):
+    # activity_weekly（社員×週）を部署×週の表にする（行: 週、列: 部署）
+    frame = weekly.merge(employee_frame(employee_master), on="employee_id", how="left")
+    frame["dept"] = frame["dept"].fillna("不明")
+    return frame.pivot_table(index="week", columns="dept", values=value, aggfunc="sum", fill_value=0)
+
+
+def completion_frame(activity, employee_master):
+    # 社員ごとの完了セッション数と、最後に振り返りを完了してからの日数
+    frame = activity.merge(employee_frame(employee_master), on="employee_id", how="left")
+    frame[["name", "dept"]] = frame[["name", "dept"]].fillna("不明")
+    frame = frame.sort_values("days_since_completion", ascending=False, na_position="first")
+    return frame[["name", "dept", "total_messages", "completed_sessions", "last_completed_at", "days_since_completion"]]
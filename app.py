@@ -1,15 +1,29 @@
 import streamlit as st
-from openai import OpenAI
-import sqlite3
-import json
 import os
-import pandas as pd
-from datetime import datetime
+import contextvars
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
+# openai・pandas（admin_analytics）は重いため、必要になる画面で読み込む
+import chat_context
+import config_store
+import db
+import jobs
+import llm_gateway
+import tracing
+
 # --- 1. 環境設定 ---
-load_dotenv()
+@st.cache_resource
+def load_env():
+    load_dotenv()
+
+load_env()
 st.set_page_config(page_title="今日の一歩", layout="wide")
+rerun_started = time.perf_counter()
+tracing.flush()  # 前回の再実行が st.rerun / st.stop で中断した場合の残り
+tracing.set_context(page="ログイン", employee_id=st.session_state.get("login_id"))
 
 # APIキー設定
 api_key = os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
@@ -17,32 +31,131 @@ if not api_key:
     st.error("APIキーが見つかりません。")
     st.stop()
 
-client = OpenAI(api_key=api_key)
+@st.cache_resource
+def get_client(api_key):
+    # クライアント（HTTP接続プールを含む）はプロセス内で共有する。再試行は llm_gateway が行うため無効にする
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, max_retries=0)
 
 # --- 2. ユーティリティ関数 ---
-def get_file_path(filename):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(base_dir, filename)
+@st.cache_resource
+def init_db():
+    # スキーマ移行と目標のバックフィルはサーバープロセスごとに一度だけ実行
+    db.migrate()
+    db.backfill_goals()
 
-def load_json_data(filename):
-    path = get_file_path(filename)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:  # ←ここをutf-8に
-            return json.load(f)
-    return {}
+init_db()
 
-kpi_data = load_json_data("kpi_definitions.json")
-employee_master = load_json_data("employee_master.json")
+# 設定はプロセス内で共有し、ファイルが更新されたときだけ読み直す
+kpi_data = config_store.get_kpi_data()
+employee_master = config_store.get_employee_master()
 
-def init_db():
-    conn = sqlite3.connect(get_file_path('kpi_app.db'))
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS messages 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id TEXT, role TEXT, content TEXT, turn_count INTEGER, timestamp TEXT)''')
-    conn.commit()
-    conn.close()
+def extract_goal(raw_content):
+    # コーチの締めメッセージから目標の1文をAIで抽出（失敗時は定型文から抽出）
+    try:
+        extraction_response = tracing.create_completion(
+            client, "goal_extraction",
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "以下のコーチングメッセージから、コーチが提示した『次回の具体的な行動目標』にあたる1文だけを抜き出してください。余計な挨拶や「それでは」といった言葉は削除し、目標のみを簡潔に示してください。"},
+                {"role": "user", "content": raw_content}
+            ]
+        )
+        return extraction_response.choices[0].message.content.strip()
+    except Exception:
+        return db.parse_goal_text(raw_content)
+
+# --- LLM呼び出しの並列実行設定（同時実行数・流量・再試行は llm_gateway でプロセス全体として制御する） ---
+SUMMARY_MAX_WORKERS = int(os.getenv("SUMMARY_MAX_WORKERS", "8"))      # 同時に投げる要約リクエスト数の上限
+SUMMARY_TIMEOUT_SEC = float(os.getenv("SUMMARY_TIMEOUT_SEC", "30"))  # 1リクエストあたりのタイムアウト
+
+# 管理者画面の活動履歴1ページあたりの件数
+HISTORY_PAGE_SIZE = 50
+# 全文検索の1ページあたりの件数
+SEARCH_PAGE_SIZE = 20
+
+# --- バックグラウンドジョブ ---
+@st.cache_resource
+def start_job_workers():
+    jobs.start_workers(client)
+
+def show_job_result(kind, employee_id, params_hash=None):
+    # 待機中・実行中の間だけ数秒ごとに状態を確認する。完了・失敗したものはポーリングせずに表示する
+    latest = db.get_latest_job(kind, employee_id, params_hash)
+    if latest and latest["status"] in ("queued", "running"):
+        poll_job_result(kind, employee_id, params_hash)
+    else:
+        render_job_result(kind, employee_id, params_hash, latest)
+
+def render_job_result(kind, employee_id, params_hash, latest):
+    done = latest if latest and latest["status"] == "done" else db.get_latest_job(kind, employee_id, params_hash, status="done")
+    if latest and latest["status"] in ("queued", "running"):
+        st.info("⏳ AIが生成中です。この画面は操作を続けられます（完了すると自動で表示されます）。")
+    elif latest and latest["status"] == "failed":
+        st.warning(f"生成に失敗しました: {latest['error']}")
+    if done:
+        if kind == "evaluation":
+            st.success(f"AI評価案（{done['finished_at']} 生成）：")
+        st.markdown(done["result"])
+
+@st.fragment(run_every=3)
+def poll_job_result(kind, employee_id, params_hash):
+    # ジョブの状態だけを数秒ごとに再描画する（ページ全体は再実行しない）。終わったらページを再実行してポーリングを止める
+    latest = db.get_latest_job(kind, employee_id, params_hash)
+    if not (latest and latest["status"] in ("queued", "running")):
+        st.rerun()
+    render_job_result(kind, employee_id, params_hash, latest)
 
-init_db()
+def show_batch_progress(job_ids):
+    progress = db.get_jobs_progress(job_ids)
+    if progress.get("done", 0) + progress.get("failed", 0) < len(job_ids):
+        poll_batch_progress(job_ids)
+    else:
+        render_batch_progress(job_ids, progress)
+
+def render_batch_progress(job_ids, progress):
+    finished = progress.get("done", 0) + progress.get("failed", 0)
+    st.progress(finished / len(job_ids), text=f"完了 {progress.get('done', 0)} / 失敗 {progress.get('failed', 0)} / 全 {len(job_ids)} 件")
+
+@st.fragment(run_every=3)
+def poll_batch_progress(job_ids):
+    progress = db.get_jobs_progress(job_ids)
+    if progress.get("done", 0) + progress.get("failed", 0) >= len(job_ids):
+        st.rerun()
+    render_batch_progress(job_ids, progress)
+
+# --- ストリーミング応答 ---
+def stream_chat_reply(messages, page, call_site, tokens_saved=0):
+    # 生成されたトークンから順に表示し、最初のトークンまでの時間と全体の生成時間を記録する
+    started = time.perf_counter()
+    timing = {"ttft": None, "usage": None}
+    stream = llm_gateway.stream(client, model="gpt-4o-mini", messages=messages, stream=True,
+                                stream_options={"include_usage": True})
+
+    def token_stream():
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                timing["usage"] = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if timing["ttft"] is None:
+                    timing["ttft"] = time.perf_counter() - started
+                yield delta
+
+    try:
+        reply = st.write_stream(token_stream())
+    except llm_gateway.LLMUnavailableError as e:
+        tracing.record_llm_call(call_site, "gpt-4o-mini", time.perf_counter() - started, ttft_sec=timing["ttft"],
+                                status=type(e.__cause__ or e).__name__)
+        raise
+    total = time.perf_counter() - started
+    tracing.record_llm_call(call_site, "gpt-4o-mini", total, timing["usage"], ttft_sec=timing["ttft"])
+    db.save_reply_timing(st.session_state.login_id, page, timing["ttft"], total, tokens_saved)
+    if tokens_saved:
+        st.caption(f"古いやり取りを要約して {tokens_saved} トークン削減しました")
+    return reply if isinstance(reply, str) else "".join(str(r) for r in reply)
 
 # --- 3. ログイン管理（コンパクト・中央寄せ） ---
 
@@ -89,6 +202,9 @@ if "login_id" not in st.session_state:
         st.markdown("</div></div>", unsafe_allow_html=True)
     st.stop()
 
+# ログイン後に初めてLLMクライアントとワーカーを用意する（ログイン画面では openai を読み込まない）
+client = get_client(api_key)
+start_job_workers()
 
 # ユーザー情報の特定
 user_info = employee_master[st.session_state.login_id]
@@ -98,11 +214,8 @@ dept_name = user_info["department"]
 # パスワード再設定UI（サイドバー下部に表示）
 def update_password(new_pw):
     global employee_master
-    import json
-    employee_master[st.session_state.login_id]["password"] = new_pw
-    with open(get_file_path("employee_master.json"), "w", encoding="utf-8") as f:
-        json.dump(employee_master, f, ensure_ascii=False, indent=2)
-    employee_master = load_json_data("employee_master.json")
+    config_store.update_password(st.session_state.login_id, new_pw)
+    employee_master = config_store.get_employee_master()
 
 with st.sidebar:
     st.markdown("---")
@@ -164,20 +277,6 @@ with st.sidebar:
     else:
         st.caption("KPI未設定")
 with st.sidebar:
-    st.markdown("""
-        <style>
-        [data-testid="stSidebar"] { background-color: #f8f9fa; }
-        [data-testid="stSidebar"] > div:first-child { padding-top: 1rem; }
-        .step-active { color: #007bff; font-weight: bold; font-size: 0.9rem; margin-bottom: 0px; }
-        .step-inactive { color: #6c757d; font-size: 0.85rem; margin-bottom: 0px; }
-        .step-done { color: #adb5bd; text-decoration: line-through; font-size: 0.85rem; margin-bottom: 0px; }
-        .step-desc { font-size: 0.72rem; color: #868e96; margin-left: 1.2rem; margin-bottom: 8px; line-height: 1.2; }
-        .kpi-title { font-weight: bold; font-size: 0.95rem; margin-top: 1rem; margin-bottom: 0.5rem; }
-        .kpi-item { font-size: 0.82rem; line-height: 1.4; margin-bottom: 6px; }
-        hr { margin: 0.8rem 0 !important; }
-        </style>
-    """, unsafe_allow_html=True)
-
     st.title("🌱 メニュー")
     menu_options = ["振り返り対話", "マイページ（目標・AI相談）"]
     if st.session_state.login_id == "ADMIN01":
@@ -186,6 +285,7 @@ with st.sidebar:
     else:
         default_idx = 0
     page = st.radio("表示する画面を選択", menu_options, index=default_idx)
+    tracing.set_context(page=page)
     st.divider()
 
 
@@ -201,30 +301,10 @@ if page == "振り返り対話":
     st.header("🌱 今日の一歩")
     st.write(f"**{user_name} さん / {dept_name}**")
 
-    # --- 前回の目標をAIで抽出し表示（📌不要・要約ロジック強化） ---
-    conn = sqlite3.connect(get_file_path('kpi_app.db'))
-    goal_df = pd.read_sql_query(
-        "SELECT content FROM messages WHERE employee_id=? AND role='assistant' AND content LIKE '%完了しました%' ORDER BY timestamp DESC LIMIT 1", 
-        conn, params=(st.session_state.login_id,)
-    )
-    conn.close()
-    
-    if not goal_df.empty:
-        raw_content = goal_df.iloc[0]['content']
-        # 内部的にAIを使用して、目標となる一文のみを抽出する
-        try:
-            extraction_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "以下のコーチングメッセージから、コーチが提示した『次回の具体的な行動目標』にあたる1文だけを抜き出してください。余計な挨拶や「それでは」といった言葉は削除し、目標のみを簡潔に示してください。"},
-                    {"role": "user", "content": raw_content}
-                ]
-            )
-            summary = extraction_response.choices[0].message.content
-            st.info(f"🎯 **前回の目標：{summary}**")
-        except:
-            # 抽出失敗時のフォールバック
-            st.info(f"🎯 **前回の目標：目標データの解析に失敗しました。**")
+    # --- 前回の目標（振り返り完了時に抽出・保存済みのものを表示） ---
+    latest_goal = db.get_latest_goal(st.session_state.login_id)
+    if latest_goal:
+        st.info(f"🎯 **前回の目標：{latest_goal[0]}**")
     else:
         st.write("設定された目標はまだありません。今日の振り返りで決めましょう！")
 
@@ -238,6 +318,7 @@ if page == "振り返り対話":
     if "messages" not in st.session_state:
         st.session_state.messages = [{"role": "assistant", "content": "お疲れさまでした！今日の共有したいこと（売上、コスト、業務効率化、顧客満足度、トラブル）は何ですか？"}]
         st.session_state.turn_count = 1
+        st.session_state.dialogue_session_id = f"{st.session_state.login_id}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
     for msg in st.session_state.messages:
         with st.chat_message(msg["role"]):
@@ -258,28 +339,31 @@ if page == "振り返り対話":
             ターン5では必ず次週の目標をまとめ、「次回の目標は、[目標内容]です。それでは、今週の振り返りを完了しました。」と締めてください。
             """
             
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": system_prompt}] + st.session_state.messages
-            )
-            ai_msg = response.choices[0].message.content
-            st.write(ai_msg)
-            st.session_state.messages.append({"role": "assistant", "content": ai_msg})
-
-            # DB保存
-            conn = sqlite3.connect(get_file_path('kpi_app.db'))
-            c = conn.cursor()
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            c.execute("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)",
-                      (st.session_state.login_id, "user", prompt, turn, now))
-            c.execute("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)",
-                      (st.session_state.login_id, "assistant", ai_msg, turn, now))
-            conn.commit()
-            conn.close()
-
-            if st.session_state.turn_count < 5:
-                st.session_state.turn_count += 1
-                st.rerun()
+            if "coach_context" not in st.session_state:
+                st.session_state.coach_context = chat_context.new_context_state()
+            try:
+                context, tokens_saved = chat_context.build_context(
+                    client, [{"role": "system", "content": system_prompt}], st.session_state.messages, st.session_state.coach_context)
+                ai_msg = stream_chat_reply(context, "振り返り対話", "coaching", tokens_saved)
+            except llm_gateway.LLMUnavailableError:
+                # 送信内容は保存せず、同じターンのまま送り直せるようにする
+                st.session_state.messages.pop()
+                st.warning(llm_gateway.FALLBACK_MESSAGE)
+            else:
+                st.session_state.messages.append({"role": "assistant", "content": ai_msg})
+
+                # DB保存（ユーザー発言とコーチ応答を1トランザクションで）
+                now = db.now_str()
+                ai_msg_id = db.insert_turn(st.session_state.login_id, turn, prompt, ai_msg, now)
+
+                # 締めのメッセージが書かれた時点で目標を一度だけ抽出して保存
+                if turn >= 5 and "完了しました" in ai_msg:
+                    db.save_goal(st.session_state.login_id, st.session_state.get("dialogue_session_id"),
+                              extract_goal(ai_msg), now, ai_msg_id)
+
+                if st.session_state.turn_count < 5:
+                    st.session_state.turn_count += 1
+                    st.rerun()
 
 elif page == "マイページ（目標・AI相談）":
     st.header(f"📱 {user_name} さんのマイページ")
@@ -287,11 +371,9 @@ elif page == "マイページ（目標・AI相談）":
     col1, col2 = st.columns(2)
     with col1:
         st.subheader("🎯 現在の目標")
-        conn = sqlite3.connect(get_file_path('kpi_app.db'))
-        goal_df = pd.read_sql_query("SELECT content, timestamp FROM messages WHERE employee_id=? AND role='assistant' AND content LIKE '%完了しました%' ORDER BY timestamp DESC LIMIT 1", conn, params=(st.session_state.login_id,))
-        conn.close()
-        if not goal_df.empty:
-            st.success(f"**設定日: {goal_df.iloc[0]['timestamp']}**\n\n🎯 {goal_df.iloc[0]['content']}")
+        latest_goal = db.get_latest_goal(st.session_state.login_id)
+        if latest_goal:
+            st.success(f"**設定日: {latest_goal[1]}**\n\n🎯 {latest_goal[0]}")
         
         st.subheader("📓 自分用メモ")
         st.text_area("気づきを記録（非公開・一時保存）", height=200)
@@ -312,52 +394,54 @@ elif page == "マイページ（目標・AI相談）":
             with st.chat_message("user"):
                 st.write(mentor_prompt)
             with st.chat_message("assistant"):
-                with st.spinner("AIが回答中..."):
-                    res = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=st.session_state.mentor_chat
-                    )
-                    ai_reply = res.choices[0].message.content
-                    st.write(ai_reply)
+                if "mentor_context" not in st.session_state:
+                    st.session_state.mentor_context = chat_context.new_context_state()
+                try:
+                    context, tokens_saved = chat_context.build_context(
+                        client, [], st.session_state.mentor_chat, st.session_state.mentor_context)
+                    ai_reply = stream_chat_reply(context, "マイページ", "mentor", tokens_saved)
+                except llm_gateway.LLMUnavailableError:
+                    st.session_state.mentor_chat.pop()
+                    st.warning(llm_gateway.FALLBACK_MESSAGE)
+                else:
                     st.session_state.mentor_chat.append({"role": "assistant", "content": ai_reply})
 
 elif page == "管理者画面":
+    import admin_analytics
     st.header("🏆 営業活動ダッシュボード（管理者用）")
     st.caption("各担当者の営業活動を一覧・分析し、人事考課の参考にできます。")
     try:
-        conn = sqlite3.connect(get_file_path('kpi_app.db'))
-        df = pd.read_sql_query("SELECT * FROM messages ORDER BY timestamp DESC", conn)
-        conn.close()
-        if df.empty:
+        summary = db.get_activity_overview()
+        if summary.empty:
             st.info("データが蓄積されていません。")
         else:
             # --- 1. 全担当者の活動サマリー ---
 
             st.subheader("👥 担当者別 活動サマリー")
-            summary = df.groupby('employee_id').agg(
-                last_active=('timestamp', 'max')
-            ).reset_index()
-            summary['name'] = summary['employee_id'].apply(lambda x: employee_master.get(x, {}).get('name', '不明'))
-            summary['dept'] = summary['employee_id'].apply(lambda x: employee_master.get(x, {}).get('department', '不明'))
-            # 活動内容要約（AIで生成）
-            def get_activity_summary(eid):
-                logs = df[df['employee_id']==eid].sort_values('timestamp', ascending=False).head(20)
-                if logs.empty:
+            summary = admin_analytics.build_summary_frame(summary, employee_master)
+            # 活動内容要約（AIで生成）。キャッシュにない社員の分だけ直近ログを1クエリで読み込む
+            cached = db.get_cached_summaries(dict(zip(summary['employee_id'], summary['fingerprint'])))
+            summary['活動内容要約'] = summary['employee_id'].map(cached).fillna(admin_analytics.PENDING_TEXT)
+            pending = summary[~summary['employee_id'].isin(list(cached))]
+            log_texts = admin_analytics.load_log_texts(pending['employee_id'])
+
+            def get_activity_summary(eid, fingerprint):
+                log_text = log_texts.get(eid)
+                if not log_text:
                     return "-"
-                log_text = "\n".join([f"{r['timestamp']} [{r['role']}]: {r['content']}" for _, r in logs.iterrows()])
                 prompt = f"""
                 以下は営業担当者の最近の活動ログです。内容を簡潔に要約し、1ページ内で表記できる範囲（3～5行程度）でまとめてください。箇条書き推奨。
                 {log_text}
                 """
-                try:
-                    res = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[{"role": "system", "content": prompt}]
-                    )
-                    return res.choices[0].message.content.strip()
-                except:
-                    return "要約取得エラー"
-            summary['活動内容要約'] = summary['employee_id'].apply(get_activity_summary)
+                res = tracing.create_completion(
+                    client, "activity_summary", employee_id=eid,
+                    model="gpt-4o-mini",
+                    messages=[{"role": "system", "content": prompt}],
+                    timeout=SUMMARY_TIMEOUT_SEC
+                )
+                result = res.choices[0].message.content.strip()
+                db.save_cached_summary(eid, fingerprint, result)
+                return result
             # 活動内容要約をHTMLテーブルで折り返し表示
             st.markdown("""
                 <style>
@@ -366,17 +450,52 @@ elif page == "管理者画面":
                 .activity-summary-table th { background: #f8f9fa; }
                 </style>
             """, unsafe_allow_html=True)
-            table_html = "<table class='activity-summary-table'>"
-            table_html += "<tr><th>name</th><th>dept</th><th>last_active</th><th>活動内容要約</th></tr>"
-            for _, row in summary.iterrows():
-                table_html += f"<tr>"
-                table_html += f"<td>{row['name']}</td>"
-                table_html += f"<td>{row['dept']}</td>"
-                table_html += f"<td>{row['last_active']}</td>"
-                table_html += f"<td style='max-width:600px; word-break:break-all; white-space:pre-line'>{row['活動内容要約']}</td>"
-                table_html += "</tr>"
-            table_html += "</table>"
-            st.markdown(table_html, unsafe_allow_html=True)
+
+            # 要約は並列に生成し、完了した行から順に表へ反映する
+            table_area = st.empty()
+            table_area.markdown(admin_analytics.summary_table_html(summary), unsafe_allow_html=True)
+            # 操作による再実行（RerunException）で抜けたときに残りの要約を待たないよう、with は使わずに
+            # 未着手分を取り消して戻る（実行中の分はそのまま終わり、キャッシュに保存される）
+            executor = ThreadPoolExecutor(max_workers=SUMMARY_MAX_WORKERS)
+            try:
+                futures = {
+                    executor.submit(contextvars.copy_context().run, get_activity_summary, r.employee_id, r.fingerprint): idx
+                    for idx, r in zip(pending.index, pending.itertuples())
+                }
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    try:
+                        summary.at[idx, '活動内容要約'] = future.result()
+                    except Exception as e:
+                        summary.at[idx, '活動内容要約'] = f"要約取得エラー（{type(e).__name__}: {e}）"
+                    with tracing.span("render", "activity_summary_table"):
+                        table_area.markdown(admin_analytics.summary_table_html(summary), unsafe_allow_html=True)
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+            hits, misses = db.get_cache_stats("activity_summary")
+            st.caption(f"要約キャッシュ: ヒット {hits} 件 / ミス {misses} 件")
+
+            # 部署別の活動トレンド（messages は読まず、INSERT時に更新される集計テーブルだけを読む）
+            st.subheader("📈 部署別の活動トレンド")
+            trend_weeks = st.selectbox("表示期間", [4, 12, 26, 52], index=1, format_func=lambda w: f"直近{w}週")
+            since_week = (datetime.now() - timedelta(weeks=trend_weeks)).strftime("%Y-W%W")
+            weekly = db.get_weekly_activity(since_week)
+            if weekly.empty:
+                st.write("この期間の活動はありません。")
+            else:
+                trend_col1, trend_col2 = st.columns(2)
+                with trend_col1:
+                    st.markdown("**週ごとのメッセージ数**")
+                    st.line_chart(admin_analytics.department_weekly(weekly, employee_master, "messages"))
+                with trend_col2:
+                    st.markdown("**週ごとの振り返り完了数（5ターン）**")
+                    st.bar_chart(admin_analytics.department_weekly(weekly, employee_master, "completed_sessions"))
+            completion = admin_analytics.completion_frame(db.get_employee_activity(), employee_master)
+            st.markdown("**最後の振り返り完了からの日数**")
+            st.dataframe(completion.rename(columns={
+                "name": "氏名", "dept": "部署", "total_messages": "メッセージ数", "completed_sessions": "完了数",
+                "last_completed_at": "最終完了日時", "days_since_completion": "経過日数"}),
+                hide_index=True, use_container_width=True)
 
             st.divider()
             # --- 2. 個別担当者の詳細分析 ---
@@ -384,68 +503,158 @@ elif page == "管理者画面":
             target_opts = {eid: f"{info['name']} ({info['department']})" for eid, info in employee_master.items() if eid != "ADMIN01"}
             selected_eid = st.selectbox("分析する担当者を選択", options=list(target_opts.keys()), format_func=lambda x: target_opts[x])
             if selected_eid:
-                t_logs = df[df['employee_id'] == selected_eid].sort_values('timestamp', ascending=True)
                 st.markdown(f"### {employee_master[selected_eid]['name']} さんの活動履歴")
 
+                # 活動履歴は期間とページで絞り込み、表示する分だけ読み込む
+                date_col, page_col = st.columns([3, 1])
+                with date_col:
+                    date_window = st.date_input("表示期間", value=(), key="history_window")
+                start_date = date_window[0] if len(date_window) > 0 else None
+                end_date = date_window[1] if len(date_window) > 1 else start_date
+                total_rows = db.count_employee_messages(selected_eid, start_date, end_date)
+                total_pages = max(1, -(-total_rows // HISTORY_PAGE_SIZE))
+                with page_col:
+                    history_page = st.number_input("ページ", min_value=1, max_value=total_pages, value=total_pages, key=f"history_page_{selected_eid}")
+                t_logs = db.get_employee_messages(selected_eid, start_date, end_date,
+                                                  limit=HISTORY_PAGE_SIZE, offset=(history_page - 1) * HISTORY_PAGE_SIZE)
                 st.dataframe(t_logs[['timestamp','role','content','turn_count']], hide_index=True, use_container_width=True)
+                st.caption(f"全 {total_rows} 件中 {history_page}/{total_pages} ページ")
 
-                # 目標履歴（AI要約）
+                # 目標履歴（AI要約）：履歴が変わったときだけバックグラウンドで作り直す
                 with st.expander("📌 目標履歴（要約）"):
-                    goals = t_logs[t_logs['content'].str.contains('目標は|完了しました', na=False)]
-                    if not goals.empty:
-                        goal_text = "\n".join(goals['content'].tolist())
-                        prompt = f"""
-                        以下は担当者の過去の目標履歴です。重複や挨拶を除き、ポイントを簡潔にまとめてください。1ページ内で表記できる範囲（3～5行程度）で要約してください。
-                        {goal_text}
-                        """
-                        try:
-                            res = client.chat.completions.create(
-                                model="gpt-4o-mini",
-                                messages=[{"role": "system", "content": prompt}]
-                            )
-                            st.markdown(res.choices[0].message.content.strip())
-                        except:
-                            st.write("要約取得エラー")
-                    else:
+                    goal_fp = jobs.history_fingerprint(selected_eid, "goals")
+                    if goal_fp == "[]":
                         st.write("目標履歴がありません。")
-
-                # AI評価案
+                    else:
+                        goal_hash = jobs.params_hash({}, goal_fp)
+                        goal_job = db.get_latest_job("goal_history", selected_eid, goal_hash)
+                        if goal_job is None or (goal_job["status"] == "failed" and jobs.retry_due(goal_job)):
+                            jobs.enqueue("goal_history", selected_eid, {}, goal_fp)
+                        show_job_result("goal_history", selected_eid, goal_hash)
+
+                # AI評価案：ジョブとして登録し、完了したものを表示する
+                t_dept = employee_master[selected_eid]['department']
+                kpi_l = "、".join(kpi_data.get(t_dept, ["全般的貢献"]))
                 if st.button(f"{employee_master[selected_eid]['name']} さんのAI評価案を生成"):
-                    with st.spinner("AIが活動を要約・評価中..."):
-                        all_log_text = "\n".join([f"{r['timestamp']} [{r['role']}]: {r['content']}" for _, r in t_logs.iterrows()])
-                        t_dept = employee_master[selected_eid]['department']
-                        kpi_l = "、".join(kpi_data.get(t_dept, ["全般的貢献"]))
-                        prompt = f"""
-                        あなたは公平な人事評価委員です。以下のログに基づき、賞与（年2回）や昇進（年1回）の判断材料を作成してください。
-                        【部署KPI】: {kpi_l}
-                        【分析項目】:
-                        1. 活動の具体性とKPIへの貢献
-                        2. 課題発見・解決への姿勢
-                        3. チーム貢献度
-                        """
-                        ai_res = client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            messages=[
-                                {"role": "system", "content": prompt},
-                                {"role": "user", "content": all_log_text}
-                            ]
-                        )
-                        st.success("AI評価案：")
-                        st.markdown(ai_res.choices[0].message.content)
+                    jobs.enqueue("evaluation", selected_eid, {"kpi": kpi_l}, jobs.history_fingerprint(selected_eid, "activity"))
+                show_job_result("evaluation", selected_eid)
+
+            st.divider()
+            # --- 3. 部署単位の一括生成（賞与査定前など） ---
+            st.subheader("📦 部署単位でAI評価案を一括生成")
+            departments = sorted({info['department'] for eid, info in employee_master.items() if eid != "ADMIN01"})
+            batch_dept = st.selectbox("部署を選択", departments)
+            if st.button(f"{batch_dept} の全員分を登録"):
+                batch_id = f"{batch_dept}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+                kpi_l = "、".join(kpi_data.get(batch_dept, ["全般的貢献"]))
+                st.session_state.batch_job_ids = [
+                    jobs.enqueue("evaluation", eid, {"kpi": kpi_l}, jobs.history_fingerprint(eid, "activity"), batch_id)
+                    for eid, info in employee_master.items() if info['department'] == batch_dept and eid != "ADMIN01"
+                ]
+            if st.session_state.get("batch_job_ids"):
+                show_batch_progress(st.session_state.batch_job_ids)
+
+            st.divider()
+            # --- 4. 会話履歴の全文検索（FTS5 trigram索引） ---
+            st.subheader("🔎 会話履歴の全文検索")
+            search_col1, search_col2, search_col3 = st.columns([3, 1, 2])
+            with search_col1:
+                search_query = st.text_input("キーワード（スペース区切りで全てを含むものを検索）", key="search_query",
+                                             placeholder="例: 在庫差異 納期").strip()
+            with search_col2:
+                search_dept = st.selectbox("部署", ["（全部署）"] + departments, key="search_dept")
+            with search_col3:
+                search_window = st.date_input("期間", value=(), key="search_window")
+            if search_query:
+                search_ids = None if search_dept == "（全部署）" else [
+                    eid for eid, info in employee_master.items() if info['department'] == search_dept]
+                search_start = search_window[0] if len(search_window) > 0 else None
+                search_end = search_window[1] if len(search_window) > 1 else search_start
+                search_total = db.count_search_results(search_query, search_ids, search_start, search_end)
+                if search_total == 0:
+                    st.write("該当するメッセージはありません。")
+                else:
+                    search_pages = -(-search_total // SEARCH_PAGE_SIZE)
+                    search_page = st.number_input("ページ", min_value=1, max_value=search_pages, value=1,
+                                                  key=f"search_page_{search_query}_{search_dept}_{search_window}")
+                    hits = db.search_messages(search_query, search_ids, search_start, search_end,
+                                              limit=SEARCH_PAGE_SIZE, offset=(search_page - 1) * SEARCH_PAGE_SIZE)
+                    hits = hits.merge(admin_analytics.employee_frame(employee_master), on='employee_id', how='left')
+                    hits[['name', 'dept']] = hits[['name', 'dept']].fillna('不明')
+                    st.dataframe(hits[['timestamp', 'name', 'dept', 'role', 'snippet']], hide_index=True, use_container_width=True)
+                    ranked = any(len(t) >= db.FTS_MIN_CHARS for t in search_query.split())
+                    st.caption(f"全 {search_total} 件中 {search_page}/{search_pages} ページ（"
+                               + ("関連度順" if ranked else "3文字未満の語のみのため新しい順") + "）")
+
+            st.divider()
+            # --- 5. エクスポート（人事向け。一定件数ずつファイルへ書き出す） ---
+            import export
+            st.subheader("📤 会話履歴・AI評価案のエクスポート")
+            exp_col1, exp_col2, exp_col3 = st.columns(3)
+            with exp_col1:
+                export_kind = st.selectbox("出力内容", list(export.EXPORT_KINDS), format_func=lambda k: export.EXPORT_KINDS[k])
+                export_format = st.selectbox("形式", list(export.WRITERS), format_func=str.upper)
+            with exp_col2:
+                export_dept = st.selectbox("部署", ["（全部署）"] + departments, key="export_dept")
+                dept_members = [eid for eid, info in employee_master.items()
+                                if export_dept == "（全部署）" or info['department'] == export_dept]
+                export_eid = st.selectbox("担当者", ["（全員）"] + dept_members, key="export_eid",
+                                          format_func=lambda x: target_opts.get(x, x))
+            with exp_col3:
+                export_window = st.date_input("期間", value=(), key="export_window")
+            if st.button("エクスポートファイルを作成"):
+                employee_ids = export.target_employees(
+                    employee_master,
+                    None if export_dept == "（全部署）" else export_dept,
+                    None if export_eid == "（全員）" else export_eid)
+                previous = st.session_state.pop("export_file", None)
+                if previous and os.path.exists(previous["path"]):
+                    os.remove(previous["path"])
+                path = export.new_export_path(export_format)
+                with st.spinner("書き出し中..."):
+                    count = export.export(export_kind, export_format, path, employee_master, employee_ids,
+                                          export_window[0] if len(export_window) > 0 else None,
+                                          export_window[1] if len(export_window) > 1 else None)
+                st.session_state.export_file = {
+                    "path": path, "count": count,
+                    "name": f"{export_kind}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{export_format}",
+                }
+            export.cleanup_exports()
+            export_file = st.session_state.get("export_file")
+            if export_file and os.path.exists(export_file["path"]):
+                with open(export_file["path"], "rb") as f:
+                    st.download_button(f"{export_file['name']} をダウンロード（{export_file['count']} 件）", f,
+                                       file_name=export_file["name"])
     except Exception as e:
         st.error(f"データベース処理中にエラーが発生しました: {e}")
-        conn = sqlite3.connect(get_file_path('kpi_app.db'))
-        df = pd.read_sql_query("SELECT * FROM messages ORDER BY timestamp DESC", conn)
-        conn.close()
-        if not df.empty:
-            target_options = {eid: f"{info['name']} ({info['department']})" for eid, info in employee_master.items() if eid != "ADMIN01"}
-            selected_eid = st.selectbox("査定する社員を選択", options=list(target_options.keys()), format_func=lambda x: target_options[x])
-            t_logs = df[df['employee_id'] == selected_eid].sort_values('timestamp', ascending=True)
-            if st.button("評価案を生成"):
-                with st.spinner("分析中..."):
-                    all_text = "\n".join([f"{row['role']}: {row['content']}" for _, row in t_logs.iterrows()])
-                    res = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "system", "content": "人事評価者として分析して"}, {"role": "user", "content": all_text}])
-                    st.markdown(res.choices[0].message.content)
-            st.dataframe(t_logs)
-    except Exception as e:
-        st.error(f"データエラー: {e}")
\ No newline at end of file
+
+    # 計測パネル（URLに ?perf=1 を付けたときだけ表示）
+    if st.query_params.get("perf") == "1":
+        st.divider()
+        st.subheader("⏱ パフォーマンス計測")
+        days = st.selectbox("集計期間", [1, 7, 30, 90], index=1, format_func=lambda d: f"直近{d}日")
+        since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        tracing.flush()
+        calls = db.get_llm_call_stats(since)
+        if calls.empty:
+            st.write("LLM呼び出しの記録がありません。")
+        else:
+            calls['cost_usd'] = [tracing.estimate_cost(m, p, c) for m, p, c in
+                                 zip(calls['model'], calls['prompt_tokens'], calls['completion_tokens'])]
+            st.markdown("**LLM呼び出し（呼び出し箇所別）**")
+            st.dataframe(calls, hide_index=True, use_container_width=True)
+            daily = db.get_llm_daily_p95(since).pivot(index='date', columns='call_site', values='p95_ms')
+            st.markdown("**日別 p95 レイテンシ（ms）**")
+            st.line_chart(daily)
+        gateway_status = llm_gateway.status()
+        if gateway_status:
+            st.markdown("**LLMゲートウェイ（このサーバープロセス）**")
+            st.dataframe(gateway_status, hide_index=True, use_container_width=True)
+        by_span = db.get_span_stats(since)
+        if not by_span.empty:
+            st.markdown("**DBクエリ・描画・再実行（再実行ごとの平均値の分布）**")
+            st.dataframe(by_span, hide_index=True, use_container_width=True)
+
+# --- 計測の保存 ---
+tracing.record_span("rerun", page, time.perf_counter() - rerun_started)
+tracing.flush()
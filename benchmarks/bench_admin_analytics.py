@@ -0,0 +1,123 @@
+"""管理者画面の集計パイプラインのベンチマーク
+
+社員ごとのループで処理していた従来の実装と admin_analytics のパイプラインを、
+社員数・メッセージ件数を変えて比較する（LLM呼び出しは含まない）。結果はJSONで出力する。
+
+    python benchmarks/bench_admin_analytics.py --grid 100:100000 300:1000000 500:2000000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+
+def legacy_pipeline(conn, employee_master):
+    # 変更前の管理者画面と同じ処理（全件読み込み → 社員ごとに絞り込み・iterrows）
+    import pandas as pd
+    df = pd.read_sql_query("SELECT * FROM messages ORDER BY timestamp DESC", conn)
+    summary = df.groupby('employee_id').agg(last_active=('timestamp', 'max'), max_id=('id', 'max')).reset_index()
+    summary['name'] = summary['employee_id'].apply(lambda x: employee_master.get(x, {}).get('name', '不明'))
+    summary['dept'] = summary['employee_id'].apply(lambda x: employee_master.get(x, {}).get('department', '不明'))
+
+    def log_text(eid):
+        logs = df[df['employee_id'] == eid].sort_values('timestamp', ascending=False).head(20)
+        return "\n".join([f"{r['timestamp']} [{r['role']}]: {r['content']}" for _, r in logs.iterrows()])
+
+    summary['活動内容要約'] = summary['employee_id'].apply(log_text)
+    table_html = "<table class='activity-summary-table'>"
+    for _, row in summary.iterrows():
+        table_html += f"<tr><td>{row['name']}</td><td>{row['dept']}</td><td>{row['last_active']}</td><td>{row['活動内容要約']}</td></tr>"
+    return table_html + "</table>"
+
+
+def new_pipeline(employee_master):
+    import admin_analytics
+    import db
+    summary = admin_analytics.build_summary_frame(db.get_activity_overview(), employee_master)
+    log_texts = admin_analytics.load_log_texts(summary['employee_id'])
+    summary['活動内容要約'] = summary['employee_id'].map(log_texts).fillna("-")
+    return admin_analytics.summary_table_html(summary)
+
+
+def run_worker(args):
+    from seed_data import employee_ids, seed_database
+
+    seed_dir = args.seed_dir or tempfile.gettempdir()
+    seed_path = os.path.join(seed_dir, f"kpi_bench_{args.size}_{args.employees}.db")
+    if not os.path.exists(seed_path) or args.reseed:
+        seed_database(seed_path, args.size, args.employees)
+    work_dir = tempfile.mkdtemp(prefix="kpi_bench_")
+    db_path = os.path.join(work_dir, "kpi_app.db")
+    shutil.copyfile(seed_path, db_path)
+    os.environ["KPI_APP_DB"] = db_path
+
+    import db
+    db.migrate()
+    employee_master = {eid: {"name": f"社員{eid}", "department": f"部署{i % 10}"} for i, eid in enumerate(employee_ids(args.employees))}
+
+    result = {"employees": args.employees, "messages": args.size}
+    samples = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        new_pipeline(employee_master)
+        samples.append(time.perf_counter() - started)
+    result["pipeline_ms"] = min(samples) * 1000
+    if not args.skip_legacy:
+        started = time.perf_counter()
+        with db.connection() as conn:
+            legacy_pipeline(conn, employee_master)
+        result["legacy_ms"] = (time.perf_counter() - started) * 1000
+        result["speedup"] = result["legacy_ms"] / result["pipeline_ms"]
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", nargs="+", default=["100:100000", "300:1000000"], help="社員数:メッセージ件数 の組")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true", help="従来実装の計測を省く（大きな件数向け）")
+    parser.add_argument("--seed-dir", help="投入済みDBを再利用する保存先")
+    parser.add_argument("--reseed", action="store_true")
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--employees", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args), ensure_ascii=False))
+        return
+
+    results = []
+    for item in args.grid:
+        employees, size = (int(v) for v in item.split(":"))
+        cmd = [sys.executable, __file__, "--worker", "--employees", str(employees), "--size", str(size), "--repeat", str(args.repeat)]
+        if args.skip_legacy:
+            cmd.append("--skip-legacy")
+        if args.seed_dir:
+            cmd += ["--seed-dir", args.seed_dir]
+        if args.reseed:
+            cmd.append("--reseed")
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    text = json.dumps({"results": results}, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
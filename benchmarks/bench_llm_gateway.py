@@ -0,0 +1,121 @@
+"""LLMゲートウェイの検証・ベンチマーク
+
+疑似OpenAIサーバー（429を一定割合で返す）に対して、金曜午後のような同時アクセスを再現し、
+ゲートウェイを通した場合と直接呼んだ場合の成功数・サーバー側の最大同時処理数・所要時間を比べる。
+あわせて、全件失敗する障害時にサーキットブレーカーが呼び出しを止め、復旧後に戻ることを確認する。結果はJSONで出力する。
+
+    python benchmarks/bench_llm_gateway.py --callers 40 --fail-rate 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+MESSAGES = [{"role": "user", "content": "今週は見積を3件提出しました。"}]
+
+
+def run_callers(callers, call):
+    results = {"ok": 0, "failed": 0, "errors": {}}
+    lock = threading.Lock()
+
+    def one(_):
+        try:
+            call()
+            key = None
+        except Exception as e:
+            key = type(e).__name__
+        with lock:
+            if key is None:
+                results["ok"] += 1
+            else:
+                results["failed"] += 1
+                results["errors"][key] = results["errors"].get(key, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        list(executor.map(one, range(callers)))
+    results["elapsed_ms"] = (time.perf_counter() - started) * 1000
+    return results
+
+
+def scenario(name, server, callers, call):
+    server.reset_counts()
+    result = run_callers(callers, call)
+    result.update({"scenario": name, "callers": callers, "server_calls": server.call_count,
+                   "server_max_in_flight": server.max_in_flight})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--callers", type=int, default=40, help="同時に呼び出すセッション数")
+    parser.add_argument("--fail-rate", type=float, default=0.2, help="疑似サーバーが429を返す割合")
+    parser.add_argument("--latency-ms", type=int, default=200)
+    parser.add_argument("--model-concurrency", type=int, default=8)
+    parser.add_argument("--rate-per-sec", type=float, default=20)
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    from fake_openai import FakeOpenAIServer
+    from openai import OpenAI
+
+    import llm_gateway
+
+    server = FakeOpenAIServer(latency_ms=args.latency_ms, token_delay_ms=2, completion_tokens=30,
+                              fail_rate=args.fail_rate).start()
+    client = OpenAI(api_key="bench", base_url=server.base_url, max_retries=0)
+    llm_gateway.MODEL_CONCURRENCY = args.model_concurrency
+    llm_gateway.RATE_PER_SEC = args.rate_per_sec
+    llm_gateway.RATE_BURST = args.model_concurrency
+    llm_gateway.BASE_DELAY_SEC = 0.2
+    llm_gateway.BREAKER_THRESHOLD = 10 ** 6  # 集中アクセスの計測ではサーキットを開かない
+    llm_gateway.reset()
+
+    def consume_stream():
+        for _ in llm_gateway.stream(client, model="gpt-4o-mini", messages=MESSAGES, stream=True):
+            pass
+
+    results = [
+        scenario("direct", server, args.callers,
+                 lambda: client.chat.completions.create(model="gpt-4o-mini", messages=MESSAGES)),
+        scenario("gateway", server, args.callers,
+                 lambda: llm_gateway.complete(client, model="gpt-4o-mini", messages=MESSAGES)),
+        scenario("gateway_stream", server, args.callers, consume_stream),
+    ]
+
+    # 障害時：全件失敗 → サーキットが開き、サーバーへの呼び出しが止まる → 復旧後の1件で閉じる
+    llm_gateway.BREAKER_THRESHOLD = 5
+    llm_gateway.BREAKER_RESET_SEC = 1.0
+    llm_gateway.reset()
+    server.fail_rate = 1.0
+    outage = scenario("outage", server, args.callers,
+                      lambda: llm_gateway.complete(client, model="gpt-4o-mini", messages=MESSAGES))
+    outage["circuit"] = llm_gateway.status()[0]["circuit"]
+    results.append(outage)
+    server.fail_rate = 0.0
+    time.sleep(llm_gateway.BREAKER_RESET_SEC)
+    recovered = scenario("recovered", server, 1,
+                         lambda: llm_gateway.complete(client, model="gpt-4o-mini", messages=MESSAGES))
+    recovered["circuit"] = llm_gateway.status()[0]["circuit"]
+    results.append(recovered)
+    server.stop()
+
+    text = json.dumps({"fail_rate": args.fail_rate, "model_concurrency": args.model_concurrency,
+                       "results": results}, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- ローカルの疑似OpenAIサーバー ---
+# /v1/chat/completions だけを実装し、遅延と生成トークン数を指定できる。
+# OPENAI_BASE_URL をこのサーバーに向ければ、アプリのコードは変更せずに計測できる。
+
+DEFAULT_REPLY = "次回の目標は、見積提出を3件増やすことです。それでは、今週の振り返りを完了しました。"
+
+
+class FakeOpenAIServer:
+    def __init__(self, latency_ms=200, token_delay_ms=5, completion_tokens=60, fail_rate=0.0, host="127.0.0.1", port=0):
+        self.latency_ms = latency_ms            # 最初のトークンまでの遅延
+        self.token_delay_ms = token_delay_ms    # ストリーミング時のトークン間隔
+        self.completion_tokens = completion_tokens
+        self.fail_rate = fail_rate              # 429を返す割合（0～1）
+        self.call_count = 0
+        self.stream_count = 0
+        self.prompt_chars = 0
+        self.in_flight = 0
+        self.max_in_flight = 0                  # 同時に処理していたリクエスト数の最大（ゲートウェイの検証用）
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            self.call_count = 0
+            self.stream_count = 0
+            self.prompt_chars = 0
+            self.max_in_flight = self.in_flight
+
+    def reply_tokens(self):
+        # 1トークン≒1文字として、締めの定型文で終わる指定長の応答を作る
+        repeat = self.completion_tokens // len(DEFAULT_REPLY) + 1
+        return list((DEFAULT_REPLY * repeat)[-self.completion_tokens:])
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+                with server._lock:
+                    server.call_count += 1
+                    server.prompt_chars += prompt_chars
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    self._respond(body, prompt_chars)
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def _respond(self, body, prompt_chars):
+                fail = random.random() < server.fail_rate
+                time.sleep(server.latency_ms / 1000)
+                if fail:
+                    self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}})
+                    return
+                tokens = server.reply_tokens()
+                usage = {"prompt_tokens": prompt_chars, "completion_tokens": len(tokens), "total_tokens": prompt_chars + len(tokens)}
+                base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body.get("model", "gpt-4o-mini")}
+                if body.get("stream"):
+                    with server._lock:
+                        server.stream_count += 1
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for token in tokens:
+                        chunk = dict(base, object="chat.completion.chunk",
+                                     choices=[{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+                        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        time.sleep(server.token_delay_ms / 1000)
+                    last = dict(base, object="chat.completion.chunk",
+                                choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}], usage=usage)
+                    self.wfile.write(f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    return
+                self._send_json(200, dict(base, object="chat.completion", usage=usage, choices=[
+                    {"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}]))
+
+        return Handler
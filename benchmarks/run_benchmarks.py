@@ -0,0 +1,220 @@
+"""app.py のヘッドレスベンチマーク
+
+kpi_app.db に疑似履歴を投入し、ローカルの疑似OpenAIサーバーに向けたうえで、
+StreamlitのAppTestで各画面の再実行時間・DBクエリ時間・LLM呼び出し回数・ピークメモリを計測する。
+結果はJSONで出力するので、コミット間で比較できる。
+
+    python benchmarks/run_benchmarks.py --sizes 1000 100000 1000000 --output bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+APP_PATH = os.path.join(REPO_DIR, "app.py")
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from tracing import TracedConnection, TracedCursor
+
+
+# --- DBクエリ時間の計測 ---
+class QueryStats:
+    lock = threading.Lock()
+    count = 0
+    seconds = 0.0
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.count, cls.seconds = 0, 0.0
+
+    @classmethod
+    def add(cls, seconds, queries=0):
+        with cls.lock:
+            cls.count += queries
+            cls.seconds += seconds
+
+
+def _timed(method, queries=0):
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            QueryStats.add(time.perf_counter() - started, queries)
+    return wrapper
+
+
+class TimedCursor(TracedCursor):
+    execute = _timed(TracedCursor.execute, 1)
+    executemany = _timed(TracedCursor.executemany, 1)
+    fetchone = _timed(TracedCursor.fetchone)
+    fetchmany = _timed(TracedCursor.fetchmany)
+    fetchall = _timed(TracedCursor.fetchall)
+
+
+class TimedConnection(TracedConnection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+# --- 1回分の計測（サイズごとに別プロセスで実行） ---
+def run_worker(args):
+    from fake_openai import FakeOpenAIServer
+    from seed_data import seed_database
+
+    seed_dir = args.seed_dir or tempfile.gettempdir()
+    seed_path = os.path.join(seed_dir, f"kpi_bench_{args.size}_{args.employees}.db")
+    seed_started = time.perf_counter()
+    if not os.path.exists(seed_path) or args.reseed:
+        seed_database(seed_path, args.size, args.employees)
+    seed_seconds = time.perf_counter() - seed_started
+
+    work_dir = tempfile.mkdtemp(prefix="kpi_bench_")
+    db_path = os.path.join(work_dir, "kpi_app.db")
+    shutil.copyfile(seed_path, db_path)
+
+    server = FakeOpenAIServer(latency_ms=args.latency_ms, token_delay_ms=args.token_delay_ms,
+                              completion_tokens=args.completion_tokens).start()
+    os.environ.update({"KPI_APP_DB": db_path, "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": server.base_url})
+
+    import db
+    db.CONNECTION_FACTORY = TimedConnection
+    from streamlit.testing.v1 import AppTest
+
+    def new_app(login_id=None):
+        at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+        if login_id:
+            at.session_state["login_id"] = login_id
+        return at
+
+    def measure(name, prepare, action, repeat):
+        samples = []
+        for i in range(repeat + 1):
+            at = prepare()
+            QueryStats.reset()
+            server.reset_counts()
+            traced = i == repeat  # 最後の1回だけtracemallocでピークメモリを測る（計測誤差を避けるため）
+            if traced:
+                tracemalloc.start()
+            started = time.perf_counter()
+            at = action(at)
+            elapsed = time.perf_counter() - started
+            peak = None
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            errors = [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]
+            sample = {"rerun_ms": elapsed * 1000, "db_ms": QueryStats.seconds * 1000, "db_queries": QueryStats.count,
+                      "llm_calls": server.call_count, "errors": errors}
+            if traced:
+                sample["peak_mem_bytes"] = peak
+            else:
+                samples.append(sample)
+        return {
+            "scenario": name,
+            "rerun_ms_median": statistics.median(s["rerun_ms"] for s in samples),
+            "rerun_ms_max": max(s["rerun_ms"] for s in samples),
+            "db_ms_median": statistics.median(s["db_ms"] for s in samples),
+            "db_queries": samples[-1]["db_queries"],
+            "llm_calls_per_rerun": samples[-1]["llm_calls"],
+            "llm_calls_first": samples[0]["llm_calls"],
+            "peak_mem_bytes": sample["peak_mem_bytes"],
+            "errors": sorted({e for s in samples for e in s["errors"]}),
+        }
+
+    def ready(login_id, page=None):
+        def prepare():
+            at = new_app(login_id).run()
+            if page:
+                at.sidebar.radio[0].set_value(page).run()
+            return at
+        return prepare
+
+    results = [
+        measure("login", lambda: new_app(), lambda at: at.run(), args.repeat),
+        measure("振り返り対話", lambda: new_app("E001"), lambda at: at.run(), args.repeat),
+        measure("振り返り対話:chat_turn", ready("E001"), lambda at: at.chat_input[0].set_value("今週は見積を3件提出しました。").run(), args.repeat),
+        measure("マイページ", ready("E001"), lambda at: at.sidebar.radio[0].set_value("マイページ（目標・AI相談）").run(), args.repeat),
+        measure("マイページ:mentor_chat", ready("E001", "マイページ（目標・AI相談）"), lambda at: at.chat_input[0].set_value("相談です").run(), args.repeat),
+        measure("管理者画面", lambda: new_app("ADMIN01"), lambda at: at.run(), args.repeat),
+    ]
+    server.stop()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return {"messages": args.size, "employees": args.employees, "seed_seconds": seed_seconds, "scenarios": results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="投入するmessagesの件数")
+    parser.add_argument("--employees", type=int, default=50)
+    parser.add_argument("--latency-ms", type=int, default=200, help="疑似LLMの最初のトークンまでの遅延")
+    parser.add_argument("--token-delay-ms", type=int, default=5, help="疑似LLMのトークン間隔")
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=600, help="AppTest 1回あたりのタイムアウト（秒）")
+    parser.add_argument("--seed-dir", help="投入済みDBを再利用する保存先")
+    parser.add_argument("--reseed", action="store_true")
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args), ensure_ascii=False))
+        return
+
+    # db モジュールやStreamlitのキャッシュを持ち越さないよう、サイズごとに別プロセスで計測する
+    runs = []
+    passthrough = ["--employees", str(args.employees), "--latency-ms", str(args.latency_ms),
+                   "--token-delay-ms", str(args.token_delay_ms), "--completion-tokens", str(args.completion_tokens),
+                   "--repeat", str(args.repeat), "--timeout", str(args.timeout)]
+    if args.seed_dir:
+        passthrough += ["--seed-dir", args.seed_dir]
+    if args.reseed:
+        passthrough.append("--reseed")
+    for size in args.sizes:
+        out = subprocess.run([sys.executable, __file__, "--worker", "--size", str(size)] + passthrough,
+                             check=True, capture_output=True, text=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("worker", "size", "output")},
+        "runs": runs,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
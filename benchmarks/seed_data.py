@@ -0,0 +1,65 @@
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+# --- ベンチマーク用の疑似履歴 ---
+# 社員ごとに5ターン（ユーザー発言＋コーチ応答）の振り返りセッションを過去2年に散らして作る。
+
+BASE_EMPLOYEES = ["E001", "E002", "E003"]
+USER_TEMPLATES = [
+    "今週は新規顧客{n}社に訪問し、見積を{m}件提出しました。",
+    "在庫差異が{n}件見つかり、棚卸しの手順を見直しました。",
+    "納期調整で業務部と{n}回打ち合わせを行いました。",
+    "不良品の流出防止のため、検査記録を{n}件デジタル化しました。",
+    "問い合わせ対応の時間を{n}分短縮できました。",
+]
+ASSISTANT_TEMPLATE = "ありがとうございます。{n}件という数字はKPIに直結していますね。次はどんな工夫ができそうですか？"
+CLOSING_TEMPLATE = "次回の目標は、見積提出を{n}件増やすことです。それでは、今週の振り返りを完了しました。"
+
+
+def employee_ids(n_employees):
+    extra = [f"B{i:04d}" for i in range(1, max(0, n_employees - len(BASE_EMPLOYEES)) + 1)]
+    return (BASE_EMPLOYEES + extra)[:n_employees]
+
+
+def generate_messages(n_messages, n_employees, days=730, seed=42):
+    rng = random.Random(seed)
+    employees = employee_ids(n_employees)
+    per_employee = max(10, n_messages // len(employees))
+    sessions = per_employee // 10
+    interval = timedelta(days=days) / max(1, sessions)
+    start = datetime.now() - timedelta(days=days)
+    produced = 0
+    for eid in employees:
+        for s in range(sessions):
+            session_start = start + interval * s
+            for turn in range(1, 6):
+                ts = (session_start + timedelta(minutes=turn * 3)).strftime("%Y-%m-%d %H:%M:%S")
+                n, m = rng.randint(1, 20), rng.randint(1, 10)
+                yield (eid, "user", rng.choice(USER_TEMPLATES).format(n=n, m=m), turn, ts)
+                reply = CLOSING_TEMPLATE if turn == 5 else ASSISTANT_TEMPLATE
+                yield (eid, "assistant", reply.format(n=n), turn, ts)
+                produced += 2
+                if produced >= n_messages:
+                    return
+
+
+def seed_database(path, n_messages, n_employees=50):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE messages
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id TEXT, role TEXT, content TEXT, turn_count INTEGER, timestamp TEXT)""")
+    batch = []
+    for row in generate_messages(n_messages, n_employees):
+        batch.append(row)
+        if len(batch) >= 50000:
+            conn.executemany("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    conn.close()
+    return count
@@ -0,0 +1,58 @@
+import os
+
+import tracing
+from summarizer import SUMMARY_MODEL, count_tokens
+
+# --- チャットのコンテキスト管理 ---
+# システムプロンプトと直近のやり取りはそのまま送り、それより古いやり取りは要約にまとめて送る。
+# 要約はセッション状態に保持し、新しく古くなった分だけを追加で要約する（ローリング要約）。
+
+CONTEXT_BUDGET_TOKENS = int(os.getenv("CONTEXT_BUDGET_TOKENS", "3000"))
+KEEP_RECENT_MESSAGES = int(os.getenv("KEEP_RECENT_MESSAGES", "6"))
+MESSAGE_OVERHEAD_TOKENS = 4  # role等のメッセージごとの付加分
+
+ROLLING_SUMMARY_PROMPT = "以下はこれまでの会話の要約と、その続きのやり取りです。相談内容・事実・合意したことを残し、10行以内の要約に更新してください。"
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def new_context_state():
+    return {"summary": "", "summarized_count": 0}
+
+
+def _update_rolling_summary(client, state, older):
+    pending = older[state["summarized_count"]:]
+    if not pending:
+        return
+    text = "\n".join(f"[{m['role']}]: {m['content']}" for m in pending)
+    if state["summary"]:
+        text = f"【これまでの要約】\n{state['summary']}\n\n【続きのやり取り】\n{text}"
+    res = tracing.create_completion(
+        client, "context_rolling_summary",
+        model=SUMMARY_MODEL,
+        messages=[{"role": "system", "content": ROLLING_SUMMARY_PROMPT}, {"role": "user", "content": text}]
+    )
+    state["summary"] = res.choices[0].message.content.strip()
+    state["summarized_count"] = len(older)
+
+
+def build_context(client, system_messages, history, state, budget=CONTEXT_BUDGET_TOKENS):
+    # 送信するメッセージと、全文を送った場合から削減できたトークン数を返す
+    full = system_messages + history
+    full_tokens = count_message_tokens(full)
+    if full_tokens <= budget:
+        return full, 0
+
+    keep = KEEP_RECENT_MESSAGES
+    while keep > 2 and count_message_tokens(system_messages + history[-keep:]) > budget:
+        keep -= 1
+    older, recent = history[:-keep], history[-keep:]
+    _update_rolling_summary(client, state, older)
+
+    context = list(system_messages)
+    if state["summary"]:
+        context.append({"role": "system", "content": f"これまでの会話の要約：\n{state['summary']}"})
+    context += recent
+    return context, max(0, full_tokens - count_message_tokens(context))
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import db
+
+# --- 設定ファイル（社員マスタ・KPI定義）のキャッシュ ---
+# ファイルはプロセス内で一度だけ読み込み、更新日時・サイズ・内容のハッシュが変わったときだけ読み直す。
+# 返す辞書は全セッションで共有するため、呼び出し側で書き換えないこと（更新は save_json / update_password で）。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EMPLOYEE_FILE = "employee_master.json"
+KPI_FILE = "kpi_definitions.json"
+EMPLOYEE_BACKEND = os.getenv("EMPLOYEE_BACKEND", "json")  # 社員数が多い場合は "sqlite"
+
+_cache = {}  # path -> (mtime_ns, size, sha1, data)
+_lock = threading.RLock()
+
+
+def get_file_path(filename):
+    return os.path.join(BASE_DIR, filename)
+
+
+def load_json(filename):
+    path = get_file_path(filename)
+    with _lock:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            _cache.pop(path, None)
+            return {}
+        cached = _cache.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[3]
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if cached and cached[2] == digest:
+            data = cached[3]
+        else:
+            data = json.loads(raw.decode("utf-8"))
+        _cache[path] = (stat.st_mtime_ns, stat.st_size, digest, data)
+        return data
+
+
+def save_json(filename, data):
+    # 一時ファイルに書いてから置き換えるので、読み込み側が書きかけのファイルを見ることはない
+    path = get_file_path(filename)
+    with _lock:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _cache.pop(path, None)
+    return load_json(filename)
+
+
+def get_kpi_data():
+    return load_json(KPI_FILE)
+
+
+# --- 社員マスタ ---
+def _load_employees_from_db():
+    with db.connection() as conn:
+        if conn.execute("SELECT COUNT(*) FROM employees").fetchone()[0] == 0:
+            import_employees_to_db(load_json(EMPLOYEE_FILE))
+        version = db.get_employees_version()
+        cached = _cache.get("employees")
+        if cached and cached[0] == version:
+            return cached[1]
+        rows = conn.execute("SELECT employee_id, name, department, password FROM employees ORDER BY employee_id").fetchall()
+    data = {eid: {"name": name, "department": dept, "password": pw} for eid, name, dept, pw in rows}
+    _cache["employees"] = (version, data)
+    return data
+
+
+def import_employees_to_db(master):
+    with db.transaction() as c:
+        c.executemany("INSERT OR REPLACE INTO employees (employee_id, name, department, password) VALUES (?, ?, ?, ?)",
+                      [(eid, info.get("name"), info.get("department"), str(info.get("password", ""))) for eid, info in master.items()])
+        db.bump_employees_version(c)
+
+
+def get_employee_master():
+    with _lock:
+        if EMPLOYEE_BACKEND == "sqlite":
+            return _load_employees_from_db()
+        return load_json(EMPLOYEE_FILE)
+
+
+def update_password(employee_id, new_pw):
+    with _lock:
+        if EMPLOYEE_BACKEND == "sqlite":
+            with db.transaction() as c:
+                c.execute("UPDATE employees SET password=? WHERE employee_id=?", (new_pw, employee_id))
+                db.bump_employees_version(c)
+            return
+        # 最新のファイルを読み直してから、本人の分だけ書き換えて保存
+        master = {eid: dict(info) for eid, info in load_json(EMPLOYEE_FILE).items()}
+        master[employee_id]["password"] = new_pw
+        save_json(EMPLOYEE_FILE, master)
@@ -0,0 +1,687 @@
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import tracing
+
+# --- データアクセス層 ---
+# Streamlitは操作のたびにapp.pyを再実行するが、このモジュールはプロセス内で一度だけ読み込まれる。
+# Streamlitは再実行やフラグメントの更新ごとに別スレッドで動くため、接続はスレッドではなくプロセス全体の
+# プールで共有する（上限 DB_POOL_SIZE 本）。WALモードで読み取りと書き込みが互いを待たないようにする。
+
+DB_PATH = os.getenv("KPI_APP_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "kpi_app.db")
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+]
+
+# 接続クラス。クエリごとの時間を tracing に記録する（ベンチマークではさらにサブクラスへ差し替える）
+CONNECTION_FACTORY = tracing.TracedConnection
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT_SEC = 30  # 空き接続を待つ上限
+
+_pool = queue.LifoQueue()  # 最近使った接続から再利用する（ページキャッシュが温まっているため）
+_pool_lock = threading.Lock()
+_pool_created = 0
+_local = threading.local()  # このスレッドが借りている接続と入れ子の深さ
+_migrate_lock = threading.Lock()
+
+
+def now_str():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _connect():
+    # isolation_level=None: 単発の書き込みは即時コミット、まとめたい処理は transaction() を使う
+    conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None, check_same_thread=False, factory=CONNECTION_FACTORY)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _checkout():
+    global _pool_created
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        create = _pool_created < POOL_SIZE
+        if create:
+            _pool_created += 1
+    if create:
+        try:
+            return _connect()
+        except Exception:
+            with _pool_lock:
+                _pool_created -= 1
+            raise
+    try:
+        return _pool.get(timeout=POOL_TIMEOUT_SEC)
+    except queue.Empty:
+        raise sqlite3.OperationalError("DB接続の空きを待ちきれませんでした") from None
+
+
+def _release(conn):
+    if conn.in_transaction:
+        conn.execute("ROLLBACK")
+    _pool.put(conn)
+
+
+@contextmanager
+def connection():
+    # プールから接続を借り、抜けるときに返す。同じスレッドで入れ子になった場合は借りている接続をそのまま使う
+    depth = getattr(_local, "depth", 0)
+    if depth == 0:
+        _local.conn = _checkout()
+    conn = _local.conn
+    _local.depth = depth + 1
+    try:
+        yield conn
+    finally:
+        _local.depth -= 1
+        if _local.depth == 0:
+            _local.conn = None
+            _release(conn)
+
+
+def in_transaction():
+    # このスレッドが借りている接続でトランザクション中か（tracing.flush が入れ子の BEGIN を避けるため）
+    conn = getattr(_local, "conn", None)
+    return conn is not None and conn.in_transaction
+
+
+@contextmanager
+def transaction():
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+
+# 5ターン目の締めのメッセージ（振り返りの完了）かどうか
+COMPLETED_CONDITION = "({t}.role = 'assistant' AND {t}.content LIKE '%完了しました%' AND {t}.turn_count >= 5)"
+
+# --- スキーマ移行（PRAGMA user_version で適用済みのバージョンを管理） ---
+MIGRATIONS = [
+    # 1: 既存テーブル（旧 init_db で作成していたもの）
+    [
+        """CREATE TABLE IF NOT EXISTS messages
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id TEXT, role TEXT, content TEXT, turn_count INTEGER, timestamp TEXT)""",
+        """CREATE TABLE IF NOT EXISTS summary_cache
+           (employee_id TEXT PRIMARY KEY, fingerprint TEXT, summary TEXT, created_at TEXT, last_used_at TEXT)""",
+        """CREATE TABLE IF NOT EXISTS cache_stats
+           (name TEXT PRIMARY KEY, hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)""",
+        """CREATE TABLE IF NOT EXISTS goals
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id TEXT, session_id TEXT, goal TEXT, timestamp TEXT, message_id INTEGER UNIQUE)""",
+        "CREATE INDEX IF NOT EXISTS idx_goals_employee_timestamp ON goals (employee_id, timestamp)",
+        "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)",
+        """CREATE TABLE IF NOT EXISTS reply_timings
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id TEXT, page TEXT, ttft_ms INTEGER, total_ms INTEGER, timestamp TEXT)""",
+    ],
+    # 2: messages の社員別検索用インデックス
+    [
+        "CREATE INDEX IF NOT EXISTS idx_messages_employee_timestamp ON messages (employee_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_employee_role ON messages (employee_id, role)",
+    ],
+    # 3: 長期履歴の期間別要約（map-reduce要約のmap結果）
+    [
+        """CREATE TABLE IF NOT EXISTS chunk_summaries
+           (employee_id TEXT, kind TEXT, period TEXT, fingerprint TEXT, summary TEXT, tokens INTEGER, created_at TEXT,
+            PRIMARY KEY (employee_id, kind, period))""",
+    ],
+    # 4: コンテキスト圧縮で削減したトークン数
+    [
+        "ALTER TABLE reply_timings ADD COLUMN context_tokens_saved INTEGER",
+    ],
+    # 5: 社員マスタ（EMPLOYEE_BACKEND=sqlite のとき使用）
+    [
+        """CREATE TABLE IF NOT EXISTS employees
+           (employee_id TEXT PRIMARY KEY, name TEXT, department TEXT, password TEXT)""",
+        "CREATE INDEX IF NOT EXISTS idx_employees_department ON employees (department)",
+    ],
+    # 6: 計測（LLM呼び出しの台帳とDB/描画のスパン）
+    [
+        """CREATE TABLE IF NOT EXISTS llm_calls
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, call_site TEXT, page TEXT, employee_id TEXT, model TEXT, status TEXT,
+            prompt_tokens INTEGER, completion_tokens INTEGER, duration_ms INTEGER, ttft_ms INTEGER, timestamp TEXT)""",
+        "CREATE INDEX IF NOT EXISTS idx_llm_calls_timestamp ON llm_calls (timestamp, call_site)",
+        """CREATE TABLE IF NOT EXISTS perf_spans
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, name TEXT, page TEXT, employee_id TEXT, model TEXT,
+            duration_ms REAL, count INTEGER, timestamp TEXT)""",
+        "CREATE INDEX IF NOT EXISTS idx_perf_spans_timestamp ON perf_spans (timestamp, kind)",
+    ],
+    # 7: バックグラウンドジョブ（AI評価案・目標履歴の生成）
+    [
+        """CREATE TABLE IF NOT EXISTS jobs
+           (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, employee_id TEXT, params TEXT, params_hash TEXT,
+            status TEXT, result TEXT, error TEXT, batch_id TEXT, created_at TEXT, started_at TEXT, finished_at TEXT)""",
+        # 同じ内容の待機中・実行中ジョブは1件だけ
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (kind, employee_id, params_hash)
+           WHERE status IN ('queued', 'running')""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_employee ON jobs (kind, employee_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)",
+    ],
+    # 8: 活動の集計テーブル（messages への INSERT 時にトリガーで加算する）
+    [
+        """CREATE TABLE IF NOT EXISTS activity_weekly
+           (employee_id TEXT, week TEXT, messages INTEGER DEFAULT 0, completed_sessions INTEGER DEFAULT 0,
+            PRIMARY KEY (employee_id, week))""",
+        "CREATE INDEX IF NOT EXISTS idx_activity_weekly_week ON activity_weekly (week)",
+        """CREATE TABLE IF NOT EXISTS employee_activity
+           (employee_id TEXT PRIMARY KEY, total_messages INTEGER DEFAULT 0, completed_sessions INTEGER DEFAULT 0,
+            last_active TEXT, last_completed_at TEXT, max_id INTEGER)""",
+        # 既存の履歴から作成
+        f"""INSERT OR REPLACE INTO activity_weekly (employee_id, week, messages, completed_sessions)
+            SELECT employee_id, strftime('%Y-W%W', timestamp), COUNT(*), SUM({COMPLETED_CONDITION.format(t="messages")})
+            FROM messages GROUP BY employee_id, strftime('%Y-W%W', timestamp)""",
+        f"""INSERT OR REPLACE INTO employee_activity (employee_id, total_messages, completed_sessions, last_active, last_completed_at, max_id)
+            SELECT employee_id, COUNT(*), SUM({COMPLETED_CONDITION.format(t="messages")}), MAX(timestamp),
+                   MAX(CASE WHEN {COMPLETED_CONDITION.format(t="messages")} THEN timestamp END), MAX(id)
+            FROM messages GROUP BY employee_id""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_messages_rollup AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO activity_weekly (employee_id, week, messages, completed_sessions)
+                VALUES (NEW.employee_id, strftime('%Y-W%W', NEW.timestamp), 1, {COMPLETED_CONDITION.format(t="NEW")})
+                ON CONFLICT (employee_id, week) DO UPDATE SET
+                    messages = messages + 1,
+                    completed_sessions = completed_sessions + excluded.completed_sessions;
+                INSERT INTO employee_activity (employee_id, total_messages, completed_sessions, last_active, last_completed_at, max_id)
+                VALUES (NEW.employee_id, 1, {COMPLETED_CONDITION.format(t="NEW")}, NEW.timestamp,
+                        CASE WHEN {COMPLETED_CONDITION.format(t="NEW")} THEN NEW.timestamp END, NEW.id)
+                ON CONFLICT (employee_id) DO UPDATE SET
+                    total_messages = total_messages + 1,
+                    completed_sessions = completed_sessions + excluded.completed_sessions,
+                    last_active = MAX(last_active, excluded.last_active),
+                    last_completed_at = COALESCE(MAX(last_completed_at, excluded.last_completed_at), last_completed_at, excluded.last_completed_at),
+                    max_id = MAX(max_id, excluded.max_id);
+            END""",
+    ],
+    # 9: 会話履歴の全文検索（日本語は単語区切りがないため trigram で分割する。本文は messages を参照）
+    [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+           USING fts5(content, content='messages', content_rowid='id', tokenize='trigram')""",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        """CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+           BEGIN
+               INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+           BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF content ON messages
+           BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+               INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+           END""",
+    ],
+]
+
+
+def migrate():
+    with _migrate_lock, connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for i, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            with transaction() as c:
+                for sql in statements:
+                    c.execute(sql)
+                c.execute(f"PRAGMA user_version = {i}")
+
+
+# --- 振り返りメッセージ ---
+def insert_turn(employee_id, turn, user_content, assistant_content, timestamp):
+    # 1ターン分（ユーザー発言とコーチ応答）を1トランザクションで保存し、応答側のidを返す
+    with transaction() as c:
+        c.execute("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)",
+                  (employee_id, "user", user_content, turn, timestamp))
+        cur = c.execute("INSERT INTO messages (employee_id, role, content, turn_count, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        (employee_id, "assistant", assistant_content, turn, timestamp))
+        return cur.lastrowid
+
+
+# --- 目標 ---
+GOAL_PATTERN = re.compile(r"次回の目標は、(.+?)です。")
+
+
+def parse_goal_text(content):
+    # 締めの定型文から目標部分を取り出す（定型文でなければ締めの一文を除いた全文）
+    m = GOAL_PATTERN.search(content)
+    if m:
+        return m.group(1).strip()
+    return content.replace("それでは、今週の振り返りを完了しました。", "").strip()
+
+
+def backfill_goals():
+    # 既存の履歴から goals を一度だけ作成する（LLMは使わず定型文から抽出）
+    with connection() as conn:
+        if conn.execute("SELECT 1 FROM app_meta WHERE key='goals_backfilled'").fetchone():
+            return
+    with transaction() as c:
+        rows = c.execute(f"""SELECT id, employee_id, content, timestamp FROM messages
+                             WHERE {COMPLETED_CONDITION.format(t="messages")}
+                             AND id NOT IN (SELECT message_id FROM goals WHERE message_id IS NOT NULL)""").fetchall()
+        c.executemany("INSERT OR IGNORE INTO goals (employee_id, session_id, goal, timestamp, message_id) VALUES (?, ?, ?, ?, ?)",
+                      [(eid, f"backfill-{mid}", parse_goal_text(content), ts, mid) for mid, eid, content, ts in rows])
+        c.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('goals_backfilled', ?)", (now_str(),))
+
+
+def save_goal(employee_id, session_id, goal, timestamp, message_id):
+    with connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO goals (employee_id, session_id, goal, timestamp, message_id) VALUES (?, ?, ?, ?, ?)",
+                     (employee_id, session_id, goal, timestamp, message_id))
+
+
+def get_latest_goal(employee_id):
+    with connection() as conn:
+        return conn.execute(
+            "SELECT goal, timestamp FROM goals WHERE employee_id=? ORDER BY timestamp DESC, id DESC LIMIT 1", (employee_id,)
+        ).fetchone()
+
+
+# --- 社員マスタ ---
+def get_employees_version():
+    with connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key='employees_version'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def bump_employees_version(conn):
+    # 社員テーブルを書き換えたら版数を上げ、各プロセスのキャッシュを読み直させる
+    conn.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('employees_version', '0')")
+    conn.execute("UPDATE app_meta SET value = CAST(value AS INTEGER) + 1 WHERE key='employees_version'")
+
+
+# IN (...) に並べるパラメータ数の上限（SQLiteの変数上限より十分小さく）
+SQL_PARAM_CHUNK = 500
+
+
+# --- 活動要約キャッシュ ---
+SUMMARY_CACHE_MAX_ENTRIES = 500   # 保持する要約の上限件数
+SUMMARY_CACHE_MAX_AGE_DAYS = 30   # 新規メッセージがなくてもこの日数で作り直す
+
+
+def record_cache_stat(conn, name, hits, misses):
+    conn.execute("INSERT OR IGNORE INTO cache_stats (name, hits, misses) VALUES (?, 0, 0)", (name,))
+    conn.execute("UPDATE cache_stats SET hits = hits + ?, misses = misses + ? WHERE name=?", (hits, misses, name))
+
+
+def get_cached_summaries(fingerprints):
+    # {employee_id: fingerprint} を受け取り、fingerprintが一致して期限内の要約を {employee_id: summary} で返す
+    # fingerprint は "最新id:最終活動日時"（社員の最新メッセージが変わったときだけ変わる）
+    if not fingerprints:
+        return {}
+    expire = (datetime.now() - timedelta(days=SUMMARY_CACHE_MAX_AGE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    found = {}
+    with transaction() as c:
+        ids = list(fingerprints)
+        for i in range(0, len(ids), SQL_PARAM_CHUNK):
+            chunk = ids[i:i + SQL_PARAM_CHUNK]
+            rows = c.execute(f"""SELECT employee_id, fingerprint, summary FROM summary_cache
+                                 WHERE created_at >= ? AND employee_id IN ({",".join("?" * len(chunk))})""",
+                             [expire] + chunk).fetchall()
+            found.update({eid: summary for eid, fp, summary in rows if fingerprints[eid] == fp})
+        if found:
+            c.executemany("UPDATE summary_cache SET last_used_at=? WHERE employee_id=?", [(now_str(), eid) for eid in found])
+        record_cache_stat(c, "activity_summary", len(found), len(fingerprints) - len(found))
+    return found
+
+
+def save_cached_summary(employee_id, fingerprint, summary):
+    now = now_str()
+    with transaction() as c:
+        c.execute("INSERT OR REPLACE INTO summary_cache (employee_id, fingerprint, summary, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                  (employee_id, fingerprint, summary, now, now))
+        # 期限切れと上限超過分（最終利用が古い順）を削除
+        expire = (datetime.now() - timedelta(days=SUMMARY_CACHE_MAX_AGE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        c.execute("DELETE FROM summary_cache WHERE created_at < ?", (expire,))
+        c.execute("""DELETE FROM summary_cache WHERE employee_id NOT IN
+                     (SELECT employee_id FROM summary_cache ORDER BY last_used_at DESC LIMIT ?)""", (SUMMARY_CACHE_MAX_ENTRIES,))
+
+
+def get_cache_stats(name):
+    with connection() as conn:
+        row = conn.execute("SELECT hits, misses FROM cache_stats WHERE name=?", (name,)).fetchone()
+    return row or (0, 0)
+
+
+# --- 応答速度 ---
+def save_reply_timing(employee_id, page, ttft_sec, total_sec, tokens_saved=0):
+    with connection() as conn:
+        conn.execute(
+            "INSERT INTO reply_timings (employee_id, page, ttft_ms, total_ms, timestamp, context_tokens_saved) VALUES (?, ?, ?, ?, ?, ?)",
+            (employee_id, page, None if ttft_sec is None else int(ttft_sec * 1000), int(total_sec * 1000), now_str(), tokens_saved))
+
+
+# --- 管理者画面の読み込み（集計と絞り込みはSQL側で行い、画面に出す分だけ取得する） ---
+def read_dataframe(sql, params=()):
+    import pandas as pd
+    with connection() as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+def get_activity_overview():
+    # 社員ごとの最終活動日時と最新メッセージid（要約キャッシュのfingerprint用）。集計テーブルから読む
+    return read_dataframe("""SELECT employee_id, last_active, max_id FROM employee_activity ORDER BY employee_id""")
+
+
+def get_recent_windows(employee_ids, limit=20):
+    # 社員ごとの直近 limit 件を1クエリで取得（社員ごとにインデックスで先頭だけを読む）
+    frames = []
+    for i in range(0, len(employee_ids), SQL_PARAM_CHUNK):
+        chunk = list(employee_ids[i:i + SQL_PARAM_CHUNK])
+        frames.append(read_dataframe(f"""
+            WITH ids(employee_id) AS (VALUES {",".join(["(?)"] * len(chunk))})
+            SELECT m.employee_id, m.timestamp, m.role, m.content FROM ids JOIN messages m
+              ON m.id IN (SELECT r.id FROM messages r WHERE r.employee_id = ids.employee_id
+                          ORDER BY r.timestamp DESC, r.id DESC LIMIT ?)
+            ORDER BY m.employee_id, m.timestamp DESC, m.id DESC""", chunk + [limit]))
+    if not frames:
+        return read_dataframe("SELECT employee_id, timestamp, role, content FROM messages WHERE 0")
+    import pandas as pd
+    return pd.concat(frames, ignore_index=True)
+
+
+def _date_window_clause(start_date, end_date, column="timestamp"):
+    clause, params = "", []
+    if start_date:
+        clause += f" AND {column} >= ?"
+        params.append(f"{start_date} 00:00:00")
+    if end_date:
+        clause += f" AND {column} <= ?"
+        params.append(f"{end_date} 23:59:59")
+    return clause, params
+
+
+def _employee_clause(employee_ids, column="employee_id"):
+    # employee_ids=None のときは絞り込まない。件数が多くてもパラメータは1つ（JSON配列）
+    if employee_ids is None:
+        return "", []
+    return f" AND {column} IN (SELECT value FROM json_each(?))", [json.dumps(list(employee_ids), ensure_ascii=False)]
+
+
+def count_employee_messages(employee_id, start_date=None, end_date=None):
+    clause, params = _date_window_clause(start_date, end_date)
+    with connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM messages WHERE employee_id=?{clause}", [employee_id] + params).fetchone()[0]
+
+
+def get_employee_messages(employee_id, start_date=None, end_date=None, limit=None, offset=0):
+    # limit=None のときは期間内を全件（古い順）
+    clause, params = _date_window_clause(start_date, end_date)
+    sql = f"""SELECT id, timestamp, role, content, turn_count FROM messages
+              WHERE employee_id=?{clause} ORDER BY timestamp ASC, id ASC"""
+    params = [employee_id] + params
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    return read_dataframe(sql, params)
+
+
+# --- 期間別要約（map-reduce） ---
+PERIOD_EXPRESSIONS = {
+    "week": "strftime('%Y-W%W', timestamp)",
+    "month": "substr(timestamp, 1, 7)",
+}
+HISTORY_FILTERS = {
+    "activity": "",
+    "goals": " AND (content LIKE '%目標は%' OR content LIKE '%完了しました%')",
+}
+
+
+def get_period_fingerprints(employee_id, kind, period):
+    # 期間ごとの最新id・件数。新しいメッセージが入った期間だけ値が変わる
+    expr = PERIOD_EXPRESSIONS[period]
+    with connection() as conn:
+        rows = conn.execute(
+            f"""SELECT {expr} AS period_key, MAX(id), COUNT(*) FROM messages
+                WHERE employee_id=?{HISTORY_FILTERS[kind]} GROUP BY period_key ORDER BY period_key""", (employee_id,)).fetchall()
+    return [(key, f"{max_id}:{count}") for key, max_id, count in rows]
+
+
+def get_period_messages(employee_id, kind, period, period_key):
+    expr = PERIOD_EXPRESSIONS[period]
+    with connection() as conn:
+        return conn.execute(
+            f"""SELECT timestamp, role, content FROM messages
+                WHERE employee_id=?{HISTORY_FILTERS[kind]} AND {expr}=? ORDER BY timestamp ASC, id ASC""",
+            (employee_id, period_key)).fetchall()
+
+
+def get_chunk_summary(employee_id, kind, period_key, fingerprint):
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT summary FROM chunk_summaries WHERE employee_id=? AND kind=? AND period=? AND fingerprint=?",
+            (employee_id, kind, period_key, fingerprint)).fetchone()
+    return row[0] if row else None
+
+
+def save_chunk_summary(employee_id, kind, period_key, fingerprint, summary, tokens):
+    with connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO chunk_summaries (employee_id, kind, period, fingerprint, summary, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (employee_id, kind, period_key, fingerprint, summary, tokens, now_str()))
+
+
+# --- 計測データ（管理者用パネル） ---
+PERF_RETENTION_DAYS = int(os.getenv("PERF_RETENTION_DAYS", "90"))  # 計測データの保存期間（パネルの最長期間）
+
+
+def _percentile_sql(p):
+    # ウィンドウ関数で付けた順位（rn / n）から最近傍順位法のパーセンタイルを取り出す
+    # 順位は ceil(p * n)（n=10 の p95 は10番目）。SQLite の ceil は組み込まれていない場合があるため切り上げで計算する
+    return f"MAX(CASE WHEN rn = MAX(1, CAST({p} * n + 0.999999 AS INTEGER)) THEN value END)"
+
+
+def get_llm_call_stats(since):
+    # 呼び出し箇所・モデル別の件数、エラー数、p50/p95、トークン合計（集計はSQL側で行う）
+    return read_dataframe(f"""
+        WITH ranked AS (
+            SELECT call_site, model, status, prompt_tokens, completion_tokens, duration_ms AS value,
+                   ROW_NUMBER() OVER (PARTITION BY call_site, model ORDER BY duration_ms) AS rn,
+                   COUNT(*) OVER (PARTITION BY call_site, model) AS n
+            FROM llm_calls WHERE timestamp >= ?)
+        SELECT call_site, model, COUNT(*) AS calls, SUM(status != 'ok') AS errors,
+               {_percentile_sql(0.5)} AS p50_ms, {_percentile_sql(0.95)} AS p95_ms,
+               SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens
+        FROM ranked GROUP BY call_site, model ORDER BY call_site, model""", (since,))
+
+
+def get_llm_daily_p95(since):
+    return read_dataframe(f"""
+        WITH ranked AS (
+            SELECT substr(timestamp, 1, 10) AS date, call_site, duration_ms AS value,
+                   ROW_NUMBER() OVER (PARTITION BY substr(timestamp, 1, 10), call_site ORDER BY duration_ms) AS rn,
+                   COUNT(*) OVER (PARTITION BY substr(timestamp, 1, 10), call_site) AS n
+            FROM llm_calls WHERE timestamp >= ?)
+        SELECT date, call_site, {_percentile_sql(0.95)} AS p95_ms
+        FROM ranked GROUP BY date, call_site ORDER BY date""", (since,))
+
+
+def get_span_stats(since, limit=50):
+    # 種類・名前別の合計と、再実行ごとの平均値（duration_ms / count）の p50/p95
+    return read_dataframe(f"""
+        WITH ranked AS (
+            SELECT kind, name, count, duration_ms, duration_ms / MAX(count, 1) AS value,
+                   ROW_NUMBER() OVER (PARTITION BY kind, name ORDER BY duration_ms / MAX(count, 1)) AS rn,
+                   COUNT(*) OVER (PARTITION BY kind, name) AS n
+            FROM perf_spans WHERE timestamp >= ?)
+        SELECT kind, name, SUM(count) AS count, SUM(duration_ms) AS total_ms,
+               {_percentile_sql(0.5)} AS p50_ms, {_percentile_sql(0.95)} AS p95_ms
+        FROM ranked GROUP BY kind, name ORDER BY total_ms DESC LIMIT ?""", (since, limit))
+
+
+def prune_perf_data(conn, retention_days=PERF_RETENTION_DAYS):
+    # 保存期間を過ぎた計測データを削除する（tracing.flush から定期的に呼ぶ）
+    before = (datetime.now() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("DELETE FROM perf_spans WHERE timestamp < ?", (before,))
+    conn.execute("DELETE FROM llm_calls WHERE timestamp < ?", (before,))
+
+
+# --- バックグラウンドジョブ ---
+JOB_COLUMNS = "id, kind, employee_id, params, params_hash, status, result, error, batch_id, created_at, started_at, finished_at"
+
+
+def _job_dict(row):
+    return dict(zip([c.strip() for c in JOB_COLUMNS.split(",")], row)) if row else None
+
+
+def enqueue_job(kind, employee_id, params, params_hash, batch_id=None):
+    # 同じ内容のジョブが待機中・実行中ならそのidを返す（重複登録しない）
+    with transaction() as c:
+        c.execute("""INSERT OR IGNORE INTO jobs (kind, employee_id, params, params_hash, status, batch_id, created_at)
+                      VALUES (?, ?, ?, ?, 'queued', ?, ?)""", (kind, employee_id, params, params_hash, batch_id, now_str()))
+        row = c.execute("""SELECT id FROM jobs WHERE kind=? AND employee_id=? AND params_hash=?
+                           AND status IN ('queued', 'running')""", (kind, employee_id, params_hash)).fetchone()
+    return row[0] if row else None
+
+
+def claim_next_job():
+    # ポーリングのたびに書き込みロックを取らないよう、待機中のジョブがあるときだけ書き込む。
+    # 複数のワーカーが同じ行を見ても、UPDATE の status 条件で取得できるのは1つだけ
+    with connection() as conn:
+        if conn.execute("SELECT 1 FROM jobs WHERE status='queued' LIMIT 1").fetchone() is None:
+            return None
+        rows = conn.execute(
+            f"""UPDATE jobs SET status='running', started_at=?
+                WHERE id = (SELECT id FROM jobs WHERE status='queued' ORDER BY id LIMIT 1) AND status='queued'
+                RETURNING {JOB_COLUMNS}""",
+            (now_str(),),
+        ).fetchall()  # 最後まで読んで文を終わらせ、書き込みロックをすぐ手放す
+    return _job_dict(rows[0] if rows else None)
+
+
+def finish_job(job_id, result=None, error=None):
+    with connection() as conn:
+        conn.execute("UPDATE jobs SET status=?, result=?, error=?, finished_at=? WHERE id=?",
+                     ("failed" if error else "done", result, error, now_str(), job_id))
+
+
+def requeue_running_jobs():
+    # 前回のプロセスが実行途中で終了したジョブを待機中に戻す
+    with connection() as conn:
+        conn.execute("UPDATE jobs SET status='queued', started_at=NULL WHERE status='running'")
+
+
+def get_latest_job(kind, employee_id, params_hash=None, status=None):
+    sql, params = f"SELECT {JOB_COLUMNS} FROM jobs WHERE kind=? AND employee_id=?", [kind, employee_id]
+    if params_hash is not None:
+        sql += " AND params_hash=?"
+        params.append(params_hash)
+    if status is not None:
+        sql += " AND status=?"
+        params.append(status)
+    with connection() as conn:
+        return _job_dict(conn.execute(sql + " ORDER BY id DESC LIMIT 1", params).fetchone())
+
+
+def get_jobs_progress(job_ids):
+    # 一括登録したジョブの状態別件数（他の一括登録と重複したジョブも含めて数える）
+    progress = {}
+    with connection() as conn:
+        for i in range(0, len(job_ids), SQL_PARAM_CHUNK):
+            chunk = list(job_ids[i:i + SQL_PARAM_CHUNK])
+            for status, count in conn.execute(
+                    f"SELECT status, COUNT(*) FROM jobs WHERE id IN ({','.join('?' * len(chunk))}) GROUP BY status", chunk):
+                progress[status] = progress.get(status, 0) + count
+    return progress
+
+
+# --- 活動トレンド（集計テーブルのみを読む） ---
+def get_weekly_activity(since_week):
+    return read_dataframe("""SELECT employee_id, week, messages, completed_sessions FROM activity_weekly
+                             WHERE week >= ? ORDER BY week""", (since_week,))
+
+
+def get_employee_activity():
+    return read_dataframe("""SELECT employee_id, total_messages, completed_sessions, last_active, last_completed_at,
+                                    CAST(julianday('now', 'localtime') - julianday(last_completed_at) AS INTEGER) AS days_since_completion
+                             FROM employee_activity ORDER BY employee_id""")
+
+
+# --- エクスポート（カーソルから chunk_rows 件ずつ読み、全件をメモリに載せない） ---
+EXPORT_QUERIES = {
+    "messages": ("SELECT id, timestamp, employee_id, role, turn_count, content FROM messages WHERE 1=1", "timestamp"),
+    "evaluations": ("""SELECT id, finished_at, employee_id, params, result FROM jobs
+                       WHERE kind='evaluation' AND status='done'""", "finished_at"),
+}
+
+
+def iter_export_rows(kind, employee_ids=None, start_date=None, end_date=None, chunk_rows=5000):
+    # employee_ids=None のときは全社員
+    sql, date_column = EXPORT_QUERIES[kind]
+    clause, params = _date_window_clause(start_date, end_date, date_column)
+    emp_clause, emp_params = _employee_clause(employee_ids)
+    clause, params = clause + emp_clause, params + emp_params
+    # 読み終わるまで接続を借りたままにする（途中で呼び出し側が別のクエリを実行しても干渉しないよう専用に借りる）
+    conn = _checkout()
+    try:
+        cursor = conn.execute(f"{sql}{clause} ORDER BY id", params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    finally:
+        _release(conn)
+
+
+# --- 全文検索 ---
+FTS_MIN_CHARS = 3  # trigram は3文字未満の語を索引で引けない
+
+
+def _search_query(query, employee_ids, start_date, end_date):
+    # 3文字以上の語は FTS5 の MATCH（語ごとのフレーズのAND）、それより短い語は LIKE で絞り込む
+    terms = query.split()
+    long_terms = [t for t in terms if len(t) >= FTS_MIN_CHARS]
+    clause, params = _date_window_clause(start_date, end_date, "m.timestamp")
+    emp_clause, emp_params = _employee_clause(employee_ids, "m.employee_id")
+    clause, params = clause + emp_clause, params + emp_params
+    for term in terms:
+        if len(term) < FTS_MIN_CHARS:
+            clause += " AND m.content LIKE ? ESCAPE '\\'"
+            params.append("%" + re.sub(r"([\\%_])", r"\\\1", term) + "%")
+    if long_terms:
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        return ("FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?" + clause,
+                [match] + params, True)
+    return "FROM messages m WHERE 1=1" + clause, params, False
+
+
+def count_search_results(query, employee_ids=None, start_date=None, end_date=None):
+    body, params, _ = _search_query(query, employee_ids, start_date, end_date)
+    with connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) {body}", params).fetchone()[0]
+
+
+def search_messages(query, employee_ids=None, start_date=None, end_date=None, limit=20, offset=0):
+    # 関連度順（bm25）。短い語だけの検索は関連度を出せないため新しい順
+    body, params, ranked = _search_query(query, employee_ids, start_date, end_date)
+    if not ranked:
+        return read_dataframe(f"""SELECT m.id, m.timestamp, m.employee_id, m.role, m.content AS snippet {body}
+                                  ORDER BY m.timestamp DESC, m.id DESC LIMIT ? OFFSET ?""", params + [limit, offset])
+    # 抜粋（snippet）はヒット全件ではなく表示するページの分だけ作る
+    return read_dataframe(f"""
+        WITH page AS (SELECT m.id, messages_fts.rank AS score {body} ORDER BY messages_fts.rank LIMIT ? OFFSET ?)
+        SELECT m.id, m.timestamp, m.employee_id, m.role, snippet(messages_fts, 0, '【', '】', '…', 32) AS snippet
+        FROM page JOIN messages_fts ON messages_fts.rowid = page.id JOIN messages m ON m.id = page.id
+        WHERE messages_fts MATCH ? ORDER BY page.score""", params + [limit, offset, params[0]])
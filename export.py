@@ -0,0 +1,137 @@
+"""会話履歴・AI評価案のエクスポート
+
+SQLiteから一定件数ずつ読み出してCSV/Parquetへ順に書き込むため、件数が増えてもメモリ使用量はほぼ一定。
+管理者画面のダウンロードと同じ処理をコマンドラインからも実行できる。
+
+    python export.py --kind messages --department 営業部 --start 2026-04-01 --end 2026-09-30 --output messages.csv
+    python export.py --kind evaluations --format parquet --output evaluations.parquet
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+
+import config_store
+import db
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "kpi_exports"))  # 管理者画面で作成したファイルの置き場所
+EXPORT_MAX_AGE_SEC = int(os.getenv("EXPORT_MAX_AGE_SEC", "3600"))  # これより古いファイルは削除する
+
+EXPORT_KINDS = {"messages": "会話履歴", "evaluations": "AI評価案"}
+OUTPUT_COLUMNS = {
+    "messages": ["id", "timestamp", "employee_id", "name", "department", "role", "turn_count", "content"],
+    "evaluations": ["job_id", "finished_at", "employee_id", "name", "department", "kpi", "result"],
+}
+INTEGER_COLUMNS = {"id", "job_id", "turn_count"}
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def target_employees(employee_master, department=None, employee_id=None):
+    # 絞り込みなしは None（全社員）
+    if employee_id:
+        return [employee_id]
+    if department:
+        return [eid for eid, info in employee_master.items() if info.get("department") == department]
+    return None
+
+
+def iter_records(kind, employee_master, employee_ids=None, start_date=None, end_date=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # OUTPUT_COLUMNS の順に並べた行を chunk_rows 件ずつ返す（氏名・部署は社員マスタから付ける）
+    for rows in db.iter_export_rows(kind, employee_ids, start_date, end_date, chunk_rows):
+        chunk = []
+        for row in rows:
+            info = employee_master.get(row[2], {})
+            name, department = info.get("name", ""), info.get("department", "")
+            if kind == "messages":
+                chunk.append((row[0], row[1], row[2], name, department, row[3], row[4], row[5]))
+            else:
+                kpi = json.loads(row[3] or "{}").get("kpi", "")
+                chunk.append((row[0], row[1], row[2], name, department, kpi, row[4]))
+        yield chunk
+
+
+def write_csv(path, columns, chunks):
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:  # Excelで文字化けしないようBOM付き
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
+
+
+def write_parquet(path, columns, chunks):
+    if pyarrow is None:
+        raise RuntimeError("Parquet形式での出力には pyarrow が必要です（pip install pyarrow）")
+    schema = pyarrow.schema([(c, pyarrow.int64() if c in INTEGER_COLUMNS else pyarrow.string()) for c in columns])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            # 1チャンク = 1行グループとして書き出す
+            arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(chunk)
+    return count
+
+
+WRITERS = {"csv": write_csv, "parquet": write_parquet}
+
+
+def cleanup_exports(max_age_sec=EXPORT_MAX_AGE_SEC):
+    # ダウンロードされないまま残ったファイル（セッションを閉じた場合など）を削除する
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    cutoff = time.time() - max_age_sec
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass  # 別のプロセスが同時に削除した場合など
+
+
+def new_export_path(fmt):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="kpi_export_", suffix=f".{fmt}", dir=EXPORT_DIR)
+    os.close(fd)
+    return path
+
+
+def export(kind, fmt, path, employee_master, employee_ids=None, start_date=None, end_date=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # 書き出した件数を返す
+    chunks = iter_records(kind, employee_master, employee_ids, start_date, end_date, chunk_rows)
+    return WRITERS[fmt](path, OUTPUT_COLUMNS[kind], chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kind", choices=list(EXPORT_KINDS), default="messages")
+    parser.add_argument("--format", choices=list(WRITERS), help="省略時は出力先の拡張子から判断（既定はcsv）")
+    parser.add_argument("--department", help="部署で絞り込む")
+    parser.add_argument("--employee", help="社員IDで絞り込む")
+    parser.add_argument("--start", help="開始日（YYYY-MM-DD）")
+    parser.add_argument("--end", help="終了日（YYYY-MM-DD、当日を含む）")
+    parser.add_argument("--chunk-rows", type=int, default=EXPORT_CHUNK_ROWS, help="1回に読み出す件数")
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    fmt = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    db.migrate()
+    employee_master = config_store.get_employee_master()
+    employee_ids = target_employees(employee_master, args.department, args.employee)
+    count = export(args.kind, fmt, args.output, employee_master, employee_ids, args.start, args.end, args.chunk_rows)
+    print(f"{EXPORT_KINDS[args.kind]} {count} 件を {args.output} に出力しました", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
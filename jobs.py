@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+import summarizer
+import tracing
+
+# --- バックグラウンドジョブ ---
+# AI評価案と目標履歴の要約は時間がかかるため、SQLiteのjobsテーブルに登録して
+# サーバープロセス内のワーカースレッドで実行する。画面側は登録して結果を後から表示するだけ。
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+POLL_INTERVAL_SEC = 1.0
+RETRY_AFTER_SEC = int(os.getenv("JOB_RETRY_AFTER_SEC", "300"))  # 失敗したジョブを画面から登録し直すまでの間隔
+FINISH_RETRIES = 5  # 結果の保存がDBのロック待ちなどで失敗したときに保存し直す回数
+
+GOAL_HISTORY_PROMPT = "以下は担当者の過去の目標履歴（期間別の要約）です。重複や挨拶を除き、ポイントを簡潔にまとめてください。1ページ内で表記できる範囲（3～5行程度）で要約してください。"
+EVALUATION_PROMPT = """
+あなたは公平な人事評価委員です。以下の期間別の活動要約に基づき、賞与（年2回）や昇進（年1回）の判断材料を作成してください。
+【部署KPI】: {kpi}
+【分析項目】:
+1. 活動の具体性とKPIへの貢献
+2. 課題発見・解決への姿勢
+3. チーム貢献度
+"""
+
+_workers = []
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def run_evaluation(client, employee_id, params):
+    # 全ログではなく、期間別に保存済みの要約（＋新しい期間分）を渡す
+    history = summarizer.get_history_context(client, employee_id, "activity")
+    res = tracing.create_completion(
+        client, "evaluation", employee_id=employee_id,
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": EVALUATION_PROMPT.format(kpi=params["kpi"])},
+            {"role": "user", "content": history}
+        ]
+    )
+    return res.choices[0].message.content
+
+
+def run_goal_history(client, employee_id, params):
+    return summarizer.summarize_history(client, employee_id, "goals", GOAL_HISTORY_PROMPT) or "目標履歴がありません。"
+
+
+HANDLERS = {
+    "evaluation": run_evaluation,
+    "goal_history": run_goal_history,
+}
+
+
+def history_fingerprint(employee_id, kind):
+    # 履歴が変わったら別ジョブとして扱うための値
+    return repr(db.get_period_fingerprints(employee_id, kind, summarizer.SUMMARY_PERIOD))
+
+
+def params_hash(params, fingerprint=""):
+    return hashlib.sha1((json.dumps(params, ensure_ascii=False, sort_keys=True) + fingerprint).encode("utf-8")).hexdigest()
+
+
+def enqueue(kind, employee_id, params, fingerprint="", batch_id=None):
+    job_id = db.enqueue_job(kind, employee_id, json.dumps(params, ensure_ascii=False), params_hash(params, fingerprint), batch_id)
+    _wakeup.set()
+    return job_id
+
+
+def retry_due(job):
+    # 失敗したジョブは、失敗から RETRY_AFTER_SEC 経つまで登録し直さない（LLMの障害中に操作のたびに登録しない）
+    finished_at = datetime.strptime(job["finished_at"], "%Y-%m-%d %H:%M:%S")
+    return datetime.now() - finished_at >= timedelta(seconds=RETRY_AFTER_SEC)
+
+
+def _finish(job_id, result=None, error=None):
+    # 生成した結果を捨てないよう、一時的な失敗なら少し待って保存し直す
+    for attempt in range(FINISH_RETRIES):
+        try:
+            db.finish_job(job_id, result=result, error=error)
+            return
+        except Exception:
+            if attempt == FINISH_RETRIES - 1:
+                raise
+            time.sleep(POLL_INTERVAL_SEC * (attempt + 1))
+
+
+def _run_job(client, job):
+    tracing.set_context(page="job", employee_id=job["employee_id"])
+    try:
+        try:
+            result = HANDLERS[job["kind"]](client, job["employee_id"], json.loads(job["params"] or "{}"))
+        except Exception as e:
+            _finish(job["id"], error=f"{type(e).__name__}: {e}")
+        else:
+            _finish(job["id"], result=result)
+    finally:
+        tracing.flush()
+
+
+def _worker_loop(client):
+    # DBのロック待ちや接続の空き待ちが上限を超えるなど、一時的なエラーでスレッドを終わらせない
+    # （start_workers はスレッドを起動し直さないため）
+    while True:
+        try:
+            job = db.claim_next_job()
+            if job is None:
+                _wakeup.wait(POLL_INTERVAL_SEC)
+                _wakeup.clear()
+                continue
+            _run_job(client, job)
+        except Exception:
+            tracing.record_span("job", "worker_error", 0)
+            _wakeup.wait(POLL_INTERVAL_SEC)
+
+
+def start_workers(client, count=JOB_WORKERS):
+    # プロセスごとに一度だけ起動する（Streamlitの再実行では増やさない）
+    with _workers_lock:
+        if _workers:
+            return
+        db.requeue_running_jobs()
+        for i in range(count):
+            thread = threading.Thread(target=_worker_loop, args=(client,), name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            _workers.append(thread)
@@ -0,0 +1,259 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import tracing
+
+# --- LLM呼び出しの共通窓口 ---
+# chat.completions.create は全てここを通す。サーバープロセス内で共有する同時実行数の上限（全体・モデル別）、
+# トークンバケットによる流量制限、ジッター付きの再試行、タイムアウト、サーキットブレーカーをまとめて扱う。
+# 金曜午後のように利用が集中しても、OpenAIのレート制限に当たる前にここで待たせる。
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))          # プロセス全体の同時リクエスト数
+MODEL_CONCURRENCY = int(os.getenv("LLM_MODEL_CONCURRENCY", "8"))       # モデルごとの同時リクエスト数
+RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", "20"))              # モデルごとの平均リクエスト数/秒
+RATE_BURST = int(os.getenv("LLM_RATE_BURST", "20"))                    # 一時的に許す連続リクエスト数
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+BASE_DELAY_SEC = float(os.getenv("LLM_BASE_DELAY_SEC", "0.5"))
+MAX_DELAY_SEC = float(os.getenv("LLM_MAX_DELAY_SEC", "8"))
+REQUEST_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "60"))        # 1リクエストあたり（呼び出し側の指定が優先）
+QUEUE_TIMEOUT_SEC = float(os.getenv("LLM_QUEUE_TIMEOUT_SEC", "30"))    # 空き枠を待つ上限
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))       # 連続失敗でサーキットを開く回数
+BREAKER_RESET_SEC = float(os.getenv("LLM_BREAKER_RESET_SEC", "30"))    # 開いてから試行を再開するまで
+
+FALLBACK_MESSAGE = "ただいまAIが混み合っているため応答できませんでした。少し時間をおいてから、もう一度送信してください。"
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"APITimeoutError", "APIConnectionError"}
+
+
+class LLMUnavailableError(Exception):
+    # 再試行しても応答が得られなかった（またはサーキットが開いている）。画面では FALLBACK_MESSAGE を表示する
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        # 1件分のトークンを取る。deadline までに取れなければ False
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    # 連続 threshold 回失敗したら reset_sec の間は呼ばずに失敗させ、その後1件だけ試して閉じるか判断する。
+    # 試行した1件が結果を返さないまま reset_sec が過ぎたら、次の1件を試す
+    def __init__(self, threshold, reset_sec):
+        self.threshold = threshold
+        self.reset_sec = reset_sec
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        # 状態を変えずに、今は呼ばずに失敗させる期間かどうかを返す（枠を待つ前の確認用）
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - max(self.opened_at, self.trial_at or 0) < self.reset_sec
+
+    def allow(self):
+        # 開いている間は False。reset_sec が過ぎていれば試行の1件として通す
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - max(self.opened_at, self.trial_at or 0) >= self.reset_sec:
+                self.trial_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if self.trial_at is None else "half_open"
+
+
+class _ModelLimits:
+    def __init__(self):
+        self.slots = threading.BoundedSemaphore(MODEL_CONCURRENCY)
+        self.bucket = TokenBucket(RATE_PER_SEC, RATE_BURST)
+        self.breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET_SEC)
+        self.in_flight = 0
+
+
+_global_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _limits(model):
+    with _models_lock:
+        if model not in _models:
+            _models[model] = _ModelLimits()
+        return _models[model]
+
+
+def reset():
+    # 設定値を変えたあとに枠・流量制限・サーキットを作り直す（ベンチマーク用）
+    global _global_slots
+    with _models_lock:
+        _models.clear()
+        _global_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+
+def status():
+    # 計測パネル用（モデルごとのサーキットの状態と実行中の件数）
+    with _models_lock:
+        items = list(_models.items())
+    return [{"model": model, "circuit": limits.breaker.state, "consecutive_failures": limits.breaker.failures,
+             "in_flight": limits.in_flight} for model, limits in items]
+
+
+def is_retryable(error):
+    return type(error).__name__ in RETRYABLE_ERRORS or getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt, retry_after=None):
+    # full jitter（0～上限の一様乱数）で、同時に失敗した呼び出しの再試行が重ならないようにする
+    delay = random.uniform(0, min(MAX_DELAY_SEC, BASE_DELAY_SEC * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, min(retry_after, MAX_DELAY_SEC))
+    return delay
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+@contextmanager
+def _slot(model, limits):
+    # 全体の枠 → モデルの枠 → 流量制限の順に確保する。サーキットが開いていれば何も確保せずに失敗させ、
+    # 待っている間に開いた場合や、試行の1件を通すかどうかは確保した後に判断する
+    if limits.breaker.is_open():
+        _circuit_open(model)
+    started = time.monotonic()
+    deadline = started + QUEUE_TIMEOUT_SEC
+    if not _global_slots.acquire(timeout=QUEUE_TIMEOUT_SEC):
+        raise LLMUnavailableError("LLM呼び出しの空き枠を待ちきれませんでした")
+    try:
+        if not limits.slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise LLMUnavailableError(f"{model} の空き枠を待ちきれませんでした")
+        try:
+            if not limits.bucket.acquire(deadline):
+                raise LLMUnavailableError(f"{model} の流量制限の待ち時間が上限を超えました")
+            _check_circuit(model, limits)
+            tracing.record_span("gateway", "wait", time.monotonic() - started, model)
+            with _models_lock:
+                limits.in_flight += 1
+            try:
+                yield
+            finally:
+                with _models_lock:
+                    limits.in_flight -= 1
+        finally:
+            limits.slots.release()
+    finally:
+        _global_slots.release()
+
+
+def _check_circuit(model, limits):
+    if not limits.breaker.allow():
+        _circuit_open(model)
+
+
+def _circuit_open(model):
+    tracing.record_span("gateway", "circuit_open", 0, model)
+    raise LLMUnavailableError(f"{model} の呼び出しを一時停止しています（連続して失敗したため）")
+
+
+def _handle_failure(model, limits, error, attempt, can_retry=True):
+    # 再試行するなら待ってから戻り、しないなら LLMUnavailableError を送出する
+    if is_retryable(error):
+        limits.breaker.record_failure()
+    else:
+        # 入力の誤りなど再試行しても変わらないもの。APIには届いているのでサーキットの失敗には数えない
+        limits.breaker.record_success()
+    if not (can_retry and is_retryable(error)) or attempt >= MAX_RETRIES:
+        raise LLMUnavailableError(f"{type(error).__name__}: {error}") from error
+    tracing.record_span("gateway", "retry", 0, model)
+    time.sleep(backoff_delay(attempt, _retry_after(error)))
+
+
+def complete(client, **kwargs):
+    # ストリーミングしない呼び出し
+    model = kwargs.get("model")
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT_SEC)
+    limits = _limits(model)
+    attempt = 0
+    while True:
+        try:
+            with _slot(model, limits):
+                res = client.chat.completions.create(**kwargs)
+        except LLMUnavailableError:
+            raise
+        except Exception as e:
+            _handle_failure(model, limits, e, attempt)
+            attempt += 1
+            continue
+        limits.breaker.record_success()
+        return res
+
+
+def stream(client, **kwargs):
+    # ストリーミング呼び出し。最初のチャンクを受け取るまでは再試行し、受信中は枠を確保したままにする。
+    # 途中で切れた場合は表示済みの内容と重複するため再試行しない
+    model = kwargs.get("model")
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT_SEC)
+    limits = _limits(model)
+    attempt = 0
+    while True:
+        received = False
+        try:
+            with _slot(model, limits):
+                for chunk in client.chat.completions.create(**kwargs):
+                    received = True
+                    yield chunk
+        except LLMUnavailableError:
+            raise
+        except Exception as e:
+            _handle_failure(model, limits, e, attempt, can_retry=not received)
+            attempt += 1
+            continue
+        limits.breaker.record_success()
+        return
@@ -0,0 +1,132 @@
+import functools
+import hashlib
+import os
+
+import db
+import tracing
+
+# --- 長期履歴の map-reduce 要約 ---
+# 期間（週/月）ごとに一度だけ要約してSQLiteに保存し（map）、評価時は保存済みの期間要約と
+# 新しいメッセージが入った期間だけを束ねる（reduce）。履歴が伸びてもLLMに渡す量はほぼ一定になる。
+
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_PERIOD = os.getenv("SUMMARY_PERIOD", "month")                 # "week" または "month"
+MAP_CHUNK_TOKENS = int(os.getenv("MAP_CHUNK_TOKENS", "6000"))         # 1回の期間要約に渡す上限
+REDUCE_BUDGET_TOKENS = int(os.getenv("REDUCE_BUDGET_TOKENS", "8000"))  # 期間要約を束ねたときの上限
+
+MAP_PROMPTS = {
+    "activity": "以下は社員の{period}の活動ログです。KPIに関わる具体的な行動・数値・課題・次の目標を残し、挨拶や重複を除いて5～10行の箇条書きに要約してください。",
+    "goals": "以下は社員の{period}の目標に関するやり取りです。設定された目標とその達成状況だけを簡潔に箇条書きでまとめてください。",
+}
+REDUCE_PROMPT = "以下は複数期間の要約です。時系列の流れと重要な数値・成果・課題を残して、1つの要約にまとめてください。"
+
+@functools.cache
+def _get_encoding():
+    # tiktoken の読み込みとエンコーディングの取得（初回はダウンロード）は重いため、最初に数えるときまで遅らせる
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # tiktokenがない環境では概算（日本語は1文字≒1トークン、英数字は4文字≒1トークン）
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def split_by_tokens(lines, max_tokens):
+    chunks, current, current_tokens = [], [], 0
+    for line in lines:
+        tokens = count_tokens(line)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _complete(client, call_site, instruction, text, employee_id=None):
+    res = tracing.create_completion(
+        client, call_site, employee_id=employee_id,
+        model=SUMMARY_MODEL,
+        messages=[{"role": "system", "content": instruction}, {"role": "user", "content": text}]
+    )
+    return res.choices[0].message.content.strip()
+
+
+def _summarize_lines(client, instruction, lines, employee_id=None):
+    # 1回に収まらない期間は分割して要約し、さらにまとめる
+    chunks = split_by_tokens(lines, MAP_CHUNK_TOKENS)
+    if len(chunks) == 1:
+        return _complete(client, "history_map", instruction, "\n".join(chunks[0]), employee_id)
+    partials = [_complete(client, "history_map", instruction, "\n".join(chunk), employee_id) for chunk in chunks]
+    return reduce_summaries(client, partials, employee_id)
+
+
+def build_period_summaries(client, employee_id, kind, period=SUMMARY_PERIOD):
+    # 期間ごとの要約を返す。保存済みでfingerprintが一致する期間はLLMを呼ばない
+    results = []
+    for period_key, fingerprint in db.get_period_fingerprints(employee_id, kind, period):
+        summary = db.get_chunk_summary(employee_id, kind, period_key, fingerprint)
+        if summary is None:
+            rows = db.get_period_messages(employee_id, kind, period, period_key)
+            lines = [f"{ts} [{role}]: {content}" for ts, role, content in rows]
+            summary = _summarize_lines(client, MAP_PROMPTS[kind].format(period=period_key), lines, employee_id)
+            db.save_chunk_summary(employee_id, kind, period_key, fingerprint, summary, count_tokens(summary))
+        results.append((period_key, summary))
+    return results
+
+
+def _reduce_group(client, group, employee_id=None, kind=None, slot=None):
+    # 束ねた結果も入力のfingerprintで保存し、新しい期間を含まないグループは再要約しない
+    text = "\n\n".join(group)
+    if kind is None:
+        return _complete(client, "history_reduce", REDUCE_PROMPT, text, employee_id)
+    fingerprint = hashlib.sha1((REDUCE_PROMPT + text).encode("utf-8")).hexdigest()
+    summary = db.get_chunk_summary(employee_id, kind, slot, fingerprint)
+    if summary is None:
+        summary = _complete(client, "history_reduce", REDUCE_PROMPT, text, employee_id)
+        db.save_chunk_summary(employee_id, kind, slot, fingerprint, summary, count_tokens(summary))
+    return summary
+
+
+def reduce_summaries(client, summaries, employee_id=None, kind=None, level=1):
+    # 予算内ならそのまま連結、超える場合は隣接する要約をまとめて再要約する（階層的reduce）。
+    # グループは先頭から詰めるため、期間が増えても変わるのは末尾のグループだけ（kind を渡すと結果を保存する）
+    text = "\n\n".join(summaries)
+    if count_tokens(text) <= REDUCE_BUDGET_TOKENS or len(summaries) <= 1:
+        return text
+    groups = split_by_tokens(summaries, REDUCE_BUDGET_TOKENS)
+    if len(groups) == 1:
+        groups = [summaries[:len(summaries) // 2], summaries[len(summaries) // 2:]]
+    reduced = [_reduce_group(client, group, employee_id, kind, f"reduce:{level}:{i}") for i, group in enumerate(groups)]
+    return reduce_summaries(client, reduced, employee_id, kind, level + 1)
+
+
+def get_history_context(client, employee_id, kind, period=SUMMARY_PERIOD):
+    # 評価プロンプトに渡す履歴（期間見出し付きの要約）
+    items = build_period_summaries(client, employee_id, kind, period)
+    return reduce_summaries(client, [f"【{key}】\n{summary}" for key, summary in items], employee_id, kind)
+
+
+def summarize_history(client, employee_id, kind, instruction, period=SUMMARY_PERIOD):
+    # 最終要約も全期間のfingerprintで保存し、履歴が変わらなければ再生成しない
+    fingerprints = db.get_period_fingerprints(employee_id, kind, period)
+    if not fingerprints:
+        return None
+    overall = hashlib.sha1((instruction + repr(fingerprints)).encode("utf-8")).hexdigest()
+    cached = db.get_chunk_summary(employee_id, kind, "*", overall)
+    if cached is not None:
+        return cached
+    context = get_history_context(client, employee_id, kind, period)
+    summary = _complete(client, f"history_final:{kind}", instruction, context, employee_id)
+    db.save_chunk_summary(employee_id, kind, "*", overall, summary, count_tokens(summary))
+    return summary
@@ -0,0 +1,188 @@
+import contextvars
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- 再実行ごとの計測（DBクエリ・LLM呼び出し・描画） ---
+# 計測値はメモリ上にためておき、再実行の終わり（または一定件数ごと）にまとめてSQLiteへ書き込む。
+# DBクエリは同じ文ごとに件数と合計時間へ集約して1行にする。
+
+FLUSH_THRESHOLD = 200
+PRUNE_INTERVAL_SEC = 3600  # 保存期間を過ぎた計測データの削除はプロセスごとに1時間に1回
+
+# 1円未満の概算用（USD / 100万トークン）
+MODEL_PRICING = {
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+}
+
+_context = contextvars.ContextVar("trace_context", default={})
+_buffer_lock = threading.Lock()
+_span_buffer = {}   # (kind, name, page, employee_id, model) -> [duration_ms, count]
+_llm_buffer = []
+_local = threading.local()
+_last_prune = 0.0
+
+
+def set_context(**tags):
+    # 以降の計測に付けるタグ（page, employee_id）
+    _context.set({**_context.get(), **tags})
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def record_span(kind, name, duration_sec, model=None, count=1):
+    if getattr(_local, "suppressed", False):
+        return
+    ctx = _context.get()
+    key = (kind, name, ctx.get("page"), ctx.get("employee_id"), model)
+    with _buffer_lock:
+        entry = _span_buffer.setdefault(key, [0.0, 0])
+        entry[0] += duration_sec * 1000
+        entry[1] += count
+        pending = len(_span_buffer) + len(_llm_buffer)
+    if pending >= FLUSH_THRESHOLD:
+        flush()
+
+
+@contextmanager
+def span(kind, name, model=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(kind, name, time.perf_counter() - started, model)
+
+
+def record_llm_call(call_site, model, duration_sec, usage=None, status="ok", ttft_sec=None, employee_id=None):
+    ctx = _context.get()
+    prompt_tokens = getattr(usage, "prompt_tokens", None) if usage else None
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage else None
+    with _buffer_lock:
+        _llm_buffer.append((call_site, ctx.get("page"), employee_id or ctx.get("employee_id"), model, status,
+                            prompt_tokens, completion_tokens, int(duration_sec * 1000),
+                            None if ttft_sec is None else int(ttft_sec * 1000), _now()))
+    record_span("llm", call_site, duration_sec, model)
+
+
+def create_completion(client, call_site, employee_id=None, **kwargs):
+    # LLMゲートウェイ経由で呼び、所要時間とトークン使用量を記録する（ストリーミング以外）
+    import llm_gateway
+    started = time.perf_counter()
+    model = kwargs.get("model")
+    try:
+        res = llm_gateway.complete(client, **kwargs)
+    except Exception as e:
+        # ゲートウェイが包んだ場合は元の例外名（RateLimitError など）を残す
+        record_llm_call(call_site, model, time.perf_counter() - started, status=type(e.__cause__ or e).__name__,
+                        employee_id=employee_id)
+        raise
+    record_llm_call(call_site, model, time.perf_counter() - started, getattr(res, "usage", None), employee_id=employee_id)
+    return res
+
+
+def _restore(spans, calls):
+    # 書き込めなかった分をバッファへ戻し、次回の flush で保存する
+    with _buffer_lock:
+        for kind, name, page, employee_id, model, duration_ms, count in spans:
+            entry = _span_buffer.setdefault((kind, name, page, employee_id, model), [0.0, 0])
+            entry[0] += duration_ms
+            entry[1] += count
+        _llm_buffer[:0] = calls
+
+
+def flush():
+    global _last_prune
+    import db
+    if db.in_transaction():
+        # トランザクションの途中（件数のしきい値に達したときなど）は書き込まず、次の機会に回す
+        return
+    with _buffer_lock:
+        spans = [(k[0], k[1], k[2], k[3], k[4], v[0], v[1]) for k, v in _span_buffer.items()]
+        calls = list(_llm_buffer)
+        _span_buffer.clear()
+        _llm_buffer.clear()
+    if not spans and not calls:
+        return
+    now = _now()
+    _local.suppressed = True
+    try:
+        with db.transaction() as c:
+            c.executemany("""INSERT INTO perf_spans (kind, name, page, employee_id, model, duration_ms, count, timestamp)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", [s + (now,) for s in spans])
+            c.executemany("""INSERT INTO llm_calls (call_site, page, employee_id, model, status, prompt_tokens, completion_tokens,
+                             duration_ms, ttft_ms, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", calls)
+            if time.monotonic() - _last_prune >= PRUNE_INTERVAL_SEC:
+                db.prune_perf_data(c)
+                _last_prune = time.monotonic()
+    except sqlite3.Error:
+        # 計測の保存に失敗しても画面の処理は止めない（計測値は捨てずに戻す）
+        _restore(spans, calls)
+    finally:
+        _local.suppressed = False
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    price = MODEL_PRICING.get(model)
+    if not price:
+        return None
+    return ((prompt_tokens or 0) * price["input"] + (completion_tokens or 0) * price["output"]) / 1_000_000
+
+
+# --- DBクエリの計測（db のプールが作る接続のクラス） ---
+_SQL_SPACE = re.compile(r"\s+")
+
+
+def sql_span_name(sql):
+    return _SQL_SPACE.sub(" ", sql).strip()[:80]
+
+
+class TracedCursor(sqlite3.Cursor):
+    _span_name = "sql"
+
+    def _traced(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            record_span("db", self._span_name, time.perf_counter() - started, count=0)
+
+    def execute(self, sql, *args):
+        self._span_name = sql_span_name(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            record_span("db", self._span_name, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        self._span_name = sql_span_name(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            record_span("db", self._span_name, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._traced(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._traced(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._traced(sqlite3.Cursor.fetchall)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)